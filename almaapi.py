@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#
+# Clients for the Alma Users and Analytics APIs, shared by the scripts that
+# fetch report data and change user groups.
+#
+
+import logging
+import random
+import threading
+import time
+
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+# requests, BeautifulSoup and ThreadPool are imported when first used, so that
+# the scripts importing this module start quickly
+
+
+ALMA_API_BASE_URL = 'https://api-na.hosted.exlibrisgroup.com'
+ALMA_USERS_API_PATH = '/almaws/v1/users'
+# Number of rows in each page of an Analytics report, between 25 and 1000
+ALMA_ANALYTICS_API_LIMIT = 1000
+ALMA_ANALYTICS_API_MIN_LIMIT = 25
+
+# Mandatory fields that are not primary identifiers
+MANDATORY_ADDRESS_FIELDS = [ 'line1', 'email' ]
+
+# Alma allows 25 API calls per second for an institution
+DEFAULT_RATE_LIMIT = 25
+DEFAULT_MAX_RETRIES = 5
+# Seconds to wait for a connection and then for each read of a response, so that
+# a call to a server that stopped answering is retried instead of hanging the run
+DEFAULT_TIMEOUT = (10, 60)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+# HTTP sessions kept open between clients, by API key, in a long-running process
+# (see keep_sessions)
+shared_sessions = None
+
+
+def keep_sessions():
+    """
+    Keep the HTTP session of each API key open when its client is closed, and
+    reuse it for the next clients, so that their connections stay warm.
+    """
+    global shared_sessions
+    if shared_sessions is None:
+        shared_sessions = {}
+
+
+class AlmaAPIError(Exception):
+    def __init__(self, message, status_code=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+class RateLimiter:
+    """Space calls shared by several threads so that no more than rate are made per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AlmaClient:
+    """
+    Alma API client using a single pooled HTTP session.
+
+    The client can be shared by several threads. Calls are rate limited and
+    requests that fail with a connection error, a timeout, 429 or 5xx response
+    are retried with exponential backoff, honoring any Retry-After header.
+    """
+
+    def __init__(self, api_key, base_url=ALMA_API_BASE_URL, rate_limit=DEFAULT_RATE_LIMIT,
+                 max_retries=DEFAULT_MAX_RETRIES, pool_size=10, timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if shared_sessions is not None and (api_key, pool_size) in shared_sessions:
+            self.session = shared_sessions[api_key, pool_size]
+            return
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'apikey ' + api_key
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if shared_sessions is not None:
+            shared_sessions[api_key, pool_size] = self.session
+
+    def close(self):
+        if shared_sessions is None:
+            self.session.close()
+
+    def request(self, method, url, **kwargs):
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+
+        while True:
+            self.rate_limiter.wait()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+                failure = error.__class__.__name__
+
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if attempt >= self.max_retries:
+                return response
+
+            if response is not None:
+                response.close()
+                failure = response.status_code
+            delay = self.retry_delay(response, attempt)
+            logging.info("%s %s failed (%s), retrying in %.1fs" % (method, url, failure, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def retry_delay(response, attempt):
+        if response is not None:
+            try:
+                return float(response.headers['Retry-After'])
+            except (KeyError, ValueError):
+                pass
+
+        return (2 ** attempt) * 0.5 + random.uniform(0, 0.5)
+
+
+class AlmaUsersClient(AlmaClient):
+    """
+    Alma Users API client. With a UserCache, user records are read from the
+    cache while they are fresh, revalidated with their ETag when they are not,
+    and invalidated when the user is updated. A fresh cached record is enough to
+    find that a user is already in a group, but records read to update a user
+    are always revalidated, so that an update is never based on a stale record.
+    """
+
+    def __init__(self, api_key, base_url=ALMA_API_BASE_URL, cache=None, **kwargs):
+        AlmaClient.__init__(self, api_key, base_url, **kwargs)
+        self.cache = cache
+
+    def user_url(self, primary_id):
+        return self.base_url + ALMA_USERS_API_PATH + '/' + primary_id
+
+    def get_user(self, primary_id, revalidate=False):
+        """Return the record of a user; with revalidate, a fresh cached record is also checked with Alma."""
+        from bs4 import BeautifulSoup
+
+        cached = None
+        headers = {}
+        if self.cache is not None:
+            cached = self.cache.get(primary_id)
+            if cached is not None:
+                if not revalidate and cached.is_fresh(self.cache.ttl):
+                    self.cache.hits += 1
+                    return BeautifulSoup(cached.body, features='xml')
+                if cached.etag:
+                    headers['If-None-Match'] = cached.etag
+
+        response = self.request('GET', self.user_url(primary_id), headers=headers)
+        if response.status_code == 304 and cached is not None:
+            self.cache.revalidations += 1
+            self.cache.refresh(primary_id)
+            return BeautifulSoup(cached.body, features='xml')
+        if response.status_code != 200:
+            raise AlmaAPIError("GET %s returned HTTP %s" % (primary_id, response.status_code),
+                               response.status_code)
+
+        if self.cache is not None:
+            self.cache.misses += 1
+            self.cache.put(primary_id, response.text, response.headers.get('ETag'))
+
+        return BeautifulSoup(response.text, features='xml')
+
+    def update_user(self, primary_id, user, override='user_group'):
+        headers = { 'Content-Type': 'application/xml' }
+        response = self.request('PUT', self.user_url(primary_id), params={ 'override': override },
+                                data=str(user).encode('utf-8'), headers=headers)
+        if response.status_code != 200:
+            raise AlmaAPIError("PUT %s returned HTTP %s: %s" % (primary_id, response.status_code,
+                                                                response.text),
+                               response.status_code)
+
+        if self.cache is not None:
+            self.cache.invalidate(primary_id)
+
+        return response
+
+    def change_group(self, primary_id, group_name):
+        """
+        Assign the user to group_name. Returns the user's previous group, the HTTP
+        status of the last request and whether the user was updated: no update is
+        made when the user already belongs to group_name.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(primary_id)
+            if cached is not None and cached.is_fresh(self.cache.ttl):
+                from bs4 import BeautifulSoup
+                if BeautifulSoup(cached.body, features='xml').find('user_group').string == group_name:
+                    self.cache.hits += 1
+                    logging.info("Patron with barcode '%s' is already in group '%s'" % (primary_id, group_name))
+                    return group_name, 200, False
+
+        # The record sent back must reflect the current record in Alma
+        user = self.get_user(primary_id, revalidate=True)
+        previous_group = user.find('user_group').string
+
+        if previous_group == group_name:
+            logging.info("Patron with barcode '%s' is already in group '%s'" % (primary_id, group_name))
+            return previous_group, 200, False
+
+        for address in user.find_all('address'):
+            for field in MANDATORY_ADDRESS_FIELDS:
+                if address.find(field) is None:
+                    logging.info("Field %s does not exist for %s. Adding it and assigning a filler value." % (
+                        field, primary_id))
+                    new_field = user.new_tag(field)
+                    new_field.string = "FILLER"
+                    address.append(new_field)
+
+        logging.info("Reassigning patron with barcode '%s' to group '%s'" % (primary_id, group_name))
+
+        tag = user.new_tag('user_group')
+        tag.string = group_name
+        user.find('user_group').replace_with(tag)
+
+        response = self.update_user(primary_id, user)
+
+        return previous_group, response.status_code, True
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class AlmaAnalyticsClient(AlmaClient):
+    """
+    Alma Analytics API client that streams the rows of a report.
+
+    Each page is parsed incrementally as it is downloaded, and the next page is
+    requested in the background while the rows of the current one are consumed.
+    """
+
+    def __init__(self, api_key, base_url=ALMA_API_BASE_URL, page_size=ALMA_ANALYTICS_API_LIMIT, **kwargs):
+        AlmaClient.__init__(self, api_key, base_url, **kwargs)
+        self.page_size = page_size
+
+    def fetch_page(self, report_path, token=None):
+        """Return the rows of a report page, the resumption token and whether the report is finished."""
+        params = { 'limit': self.page_size }
+        if token is not None:
+            params['token'] = token
+
+        response = self.request('GET', self.base_url + report_path, params=params, stream=True)
+        if response.status_code != 200:
+            raise AlmaAPIError("Analytics report request returned HTTP %s: %s" % (response.status_code,
+                                                                                response.text),
+                               response.status_code)
+
+        rows = []
+        finished = False
+        try:
+            response.raw.decode_content = True
+            for event, element in ElementTree.iterparse(response.raw):
+                name = local_name(element.tag)
+                if name == 'Row':
+                    rows.append(OrderedDict((local_name(column.tag), column.text or '') for column in element))
+                    element.clear()
+                elif name == 'ResumptionToken':
+                    token = element.text
+                elif name == 'IsFinished':
+                    finished = element.text == 'true'
+        finally:
+            response.close()
+
+        return rows, token, finished
+
+    def iter_report(self, report_path):
+        """Yield each row of the report as an ordered dict of column names to values."""
+        from multiprocessing.pool import ThreadPool
+
+        prefetch = ThreadPool(1)
+
+        try:
+            page = self.fetch_page(report_path)
+            while True:
+                rows, token, finished = page
+                if finished or token is None:
+                    next_page = None
+                else:
+                    next_page = prefetch.apply_async(self.fetch_page, (report_path, token))
+
+                for row in rows:
+                    yield row
+
+                if next_page is None:
+                    break
+                page = next_page.get()
+        finally:
+            prefetch.terminate()
+            prefetch.join()
@@ -0,0 +1,620 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for the patron load, run against synthetic Banner exports.
+#
+#   compare: render an export and compare each record with the XML files of
+#            another load, e.g. one made by a previous version of the scripts
+#   engines: throughput of the jinja and direct XML output engines
+#   ingest: rows per second read from the export
+#   patrons: Patron construction throughput and bytes per Patron
+#   startup: time taken by the scripts to start and print their help
+#   suite: timings of the main steps of the load at several export sizes, saved
+#          as JSON and compared with a baseline
+#   workers: XML rendering throughput with different numbers of processes
+#   zipcodes: distance classification cost by size of the ZIP code list
+#
+
+import csv
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from optparse import OptionParser
+from xml.etree import ElementTree
+
+import patronload
+from outputfiles import OutputFolder, OutputZip
+from referencedata import ZipCodes
+
+
+PATRON_DATA_FIELDS = ['patron', 'per_pidm', 'id_number', 'last_name', 'first_name', 'middle_name',
+                      'street_line1', 'street_line2', 'street_line3', 'city_1', 'state_1', 'zip_1',
+                      'phone', 'alt_phone', 'email', 'stu_major', 'stu_major_desc', 'orgn_code_home',
+                      'orgn_desc', 'coadmit', 'honor_prog', 'stu_username', 'udc_id', 'pref_first_name',
+                      'termination_dt']
+FIRST_NAMES = ['Alex', 'Maria', 'Sam', 'Nguyen', 'Jordan', 'Priya', 'Chris', 'Fatima', 'Lee', 'Taylor',
+               u'José', u'Zoë', 'Mary Ann']
+LAST_NAMES = ['Smith', 'Nguyen', 'Garcia', 'Johnson', 'Lee', 'Patel', 'Brown', 'Kim', 'Lopez', 'Taylor',
+              "O'Brien", u'Muñoz', 'Smith-Jones']
+MIDDLE_NAMES = ['', '', '', 'A', 'Lynn', 'J.']
+LOCAL_ZIP_CODES = ['97201', '97202', '97203', '97204', '97205', '97206', '97209', '97210', '97211', '97212']
+DISTANCE_ZIP_CODES = ['97301', '97401', '97520', '98101', '98660', '94110', '10001', '60614']
+DEPARTMENTS = ['LIB Library', 'CS Computer Science', 'HST History', 'MTH Mathematics', 'PSY Psychology']
+NEW_DEPARTMENTS = ['DATA Data Science', 'QST Quantum Studies']
+# Relative frequency of each Banner patron type in the synthetic export
+PATRON_TYPE_WEIGHTS = [('UNDERGRADUATE', 60), ('GRADUATE', 15), ('STAFF', 8), ('FACULTY', 6),
+                       ('GRADASSISTANT', 4), ('HONOR', 3), ('ENROLLED-FACULTY', 1), ('EMERITUS', 1),
+                       ('HIGHSCHOOL', 2)]
+PHONE_FORMATS = ['%s%s%s', '(%s) %s-%s', '%s.%s.%s', '%s-%s-%s']
+# Steps faster than this are too noisy to be compared with a baseline
+MIN_REGRESSION_SECONDS = 0.05
+STARTUP_SCRIPTS = ['patronload.py', 'change-patron-group.py', 'fetch-analytics-report-data.py']
+STARTUP_RUNS = 10
+INGEST_RUNS = 3
+
+
+def weighted_choice(rng, weights):
+    value = rng.uniform(0, sum(weight for choice, weight in weights))
+    for choice, weight in weights:
+        value -= weight
+        if value <= 0:
+            return choice
+    return weights[-1][0]
+
+
+def random_phone(rng):
+    if rng.random() < 0.5:
+        area_code, exchange = '503', '725'
+    else:
+        area_code, exchange = rng.choice(['503', '971', '360']), '%03d' % rng.randint(200, 999)
+    return rng.choice(PHONE_FORMATS) % (area_code, exchange, '%04d' % rng.randint(0, 9999))
+
+
+def generate_patron_row(rng, i):
+    """Return a Banner-like patron data row, with the mix of values and missing fields of a real export."""
+    first_name = rng.choice(FIRST_NAMES)
+    if rng.random() < 0.01:
+        last_name = first_name
+    else:
+        last_name = rng.choice(LAST_NAMES)
+
+    zip_draw = rng.random()
+    if zip_draw < 0.65:
+        zip_code = rng.choice(LOCAL_ZIP_CODES)
+    elif zip_draw < 0.70:
+        zip_code = '%s-%04d' % (rng.choice(LOCAL_ZIP_CODES), rng.randint(0, 9999))
+    elif zip_draw < 0.97:
+        zip_code = rng.choice(DISTANCE_ZIP_CODES)
+    else:
+        zip_code = ''
+
+    phone = rng.choice(['', random_phone(rng), random_phone(rng), random_phone(rng)])
+    alt_phone = rng.choice(['', '', '', phone, random_phone(rng)])
+
+    department_draw = rng.random()
+    if department_draw < 0.80:
+        department = rng.choice(DEPARTMENTS)
+    elif department_draw < 0.81:
+        department = rng.choice(NEW_DEPARTMENTS)
+    else:
+        department = ''
+
+    return {
+        'patron': weighted_choice(rng, PATRON_TYPE_WEIGHTS),
+        'per_pidm': str(100000 + i),
+        'id_number': '9%08d' % i,
+        'last_name': last_name,
+        'first_name': first_name,
+        'middle_name': rng.choice(MIDDLE_NAMES),
+        'street_line1': '' if rng.random() < 0.02 else '%d SW Park Ave' % rng.randint(1, 9999),
+        'street_line2': rng.choice(['', '', '', 'Apt %d' % rng.randint(1, 400)]),
+        'city_1': 'Portland',
+        'state_1': 'OR',
+        'zip_1': zip_code,
+        'phone': phone,
+        'alt_phone': alt_phone,
+        'email': '' if rng.random() < 0.02 else 'user%d@%s' % (i, rng.choice(['pdx.edu', 'gmail.com'])),
+        'orgn_desc': department,
+        'coadmit': rng.choice(sorted(patronload.Patron.coadmits)) if rng.random() < 0.05 else '',
+        'honor_prog': 'Y' if rng.random() < 0.03 else '',
+        'stu_username': '' if rng.random() < 0.01 else 'user%d' % i,
+        'pref_first_name': rng.choice(FIRST_NAMES) if rng.random() < 0.1 else '',
+    }
+
+
+def generate_patron_data_file(file_path, rows, seed=0, changes=0.0):
+    """
+    Write a Banner-like patron export of the given number of rows. The same seed
+    always gives the same export; with changes, that fraction of the rows get a
+    different patron type, department or address, as between two nightly exports.
+    """
+    rng = random.Random(seed)
+    changes_rng = random.Random(seed + 1)
+
+    with open(file_path, 'w', encoding='ISO-8859-1', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, PATRON_DATA_FIELDS, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        for i in range(rows):
+            row = generate_patron_row(rng, i)
+            if changes and changes_rng.random() < changes:
+                change = changes_rng.choice(['patron', 'orgn_desc', 'street_line1'])
+                if change == 'patron':
+                    row['patron'] = weighted_choice(changes_rng, PATRON_TYPE_WEIGHTS)
+                elif change == 'orgn_desc':
+                    row['orgn_desc'] = changes_rng.choice(DEPARTMENTS)
+                else:
+                    row['street_line1'] = '%d SE Division St' % changes_rng.randint(1, 9999)
+            writer.writerow(row)
+
+
+def write_reference_files(folder):
+    zip_codes_file = os.path.join(folder, 'non-distance-zipcodes.txt')
+    with open(zip_codes_file, 'w') as text_file:
+        text_file.write('\n'.join(LOCAL_ZIP_CODES) + '\n')
+
+    return zip_codes_file
+
+
+def write_department_codes_file(folder):
+    departments_file = os.path.join(folder, 'departments.csv')
+    with open(departments_file, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['code', 'label'])
+        for department in DEPARTMENTS:
+            writer.writerow(department.split(' ', 1))
+
+    return departments_file
+
+
+def folder_digest(folder):
+    digest = hashlib.md5()
+    for filename in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, filename), 'rb') as output_file:
+            digest.update(output_file.read())
+
+    return digest.hexdigest()
+
+
+def prepare_patron_data(work_folder, options):
+    if options.input_file:
+        zip_codes_file = options.zip_codes_file or write_reference_files(work_folder)
+        return options.input_file, zip_codes_file
+
+    patron_data_file = os.path.join(work_folder, 'patrondata.csv')
+    generate_patron_data_file(patron_data_file, options.rows, options.seed)
+    zip_codes_file = write_reference_files(work_folder)
+
+    return patron_data_file, zip_codes_file
+
+
+def benchmark_workers(work_folder, options):
+    """Time the render/write loop of main() with different numbers of workers."""
+    patron_data_file, zip_codes_file = prepare_patron_data(work_folder, options)
+    worker_counts = [int(workers) for workers in options.workers.split(',')]
+    non_distance_zip_codes = patronload.load_zip_codes_file(zip_codes_file)
+    patron_data = patronload.load_patron_data_file(patron_data_file, non_distance_zip_codes)
+    digests = set()
+
+    for workers in worker_counts:
+        output_folder = os.path.join(work_folder, 'workers-%d' % workers)
+        os.mkdir(output_folder)
+
+        start = time.time()
+        writer = patronload.PatronFileWriter(OutputFolder(output_folder), workers)
+        for patron_list in patronload.dict_chunks(patron_data, 10000):
+            writer.write(patron_list)
+        record_count = writer.close()
+        elapsed = time.time() - start
+
+        digests.add(folder_digest(output_folder))
+        print('%d worker(s): %d records in %.2fs (%.0f records/s)' % (workers, record_count, elapsed,
+                                                                      record_count / elapsed))
+
+    if len(digests) != 1:
+        print('Output differs between worker counts')
+        return False
+
+    return True
+
+
+def benchmark_engines(work_folder, options):
+    """Compare the throughput of the XML output engines and check that their output is identical."""
+    patron_data_file, zip_codes_file = prepare_patron_data(work_folder, options)
+    non_distance_zip_codes = patronload.load_zip_codes_file(zip_codes_file)
+    patron_data = patronload.load_patron_data_file(patron_data_file, non_distance_zip_codes)
+    digests = set()
+
+    for engine in ['jinja', 'direct']:
+        output_folder = os.path.join(work_folder, engine)
+        os.mkdir(output_folder)
+
+        start = time.time()
+        writer = patronload.PatronFileWriter(OutputFolder(output_folder), engine=engine)
+        for patron_list in patronload.dict_chunks(patron_data, 10000):
+            writer.write(patron_list)
+        record_count = writer.close()
+        elapsed = time.time() - start
+
+        digests.add(folder_digest(output_folder))
+        print('%s engine: %d records in %.2fs (%.0f records/s)' % (engine, record_count, elapsed,
+                                                                   record_count / elapsed))
+
+    if len(digests) != 1:
+        print('Output differs between engines')
+        return False
+
+    return True
+
+
+def patron_size(patron):
+    """Return the size in bytes of a Patron object and of the object including its attribute values."""
+    object_size = sys.getsizeof(patron)
+    if hasattr(patron, '__dict__'):
+        object_size += sys.getsizeof(patron.__dict__)
+        values = patron.__dict__.values()
+    else:
+        values = [getattr(patron, slot, None) for slot in patron.__slots__]
+
+    value_size = 0
+    seen = set()
+    for value in values:
+        if value is not None and id(value) not in seen:
+            seen.add(id(value))
+            value_size += sys.getsizeof(value)
+
+    return object_size, object_size + value_size
+
+
+def benchmark_patrons(work_folder, options):
+    """Measure Patron construction throughput and the memory used per Patron."""
+    patron_data_file, zip_codes_file = prepare_patron_data(work_folder, options)
+    non_distance_zip_codes = patronload.load_zip_codes_file(zip_codes_file)
+
+    start = time.time()
+    patron_data = patronload.load_patron_data_file(patron_data_file, non_distance_zip_codes)
+    elapsed = time.time() - start
+
+    sizes = [patron_size(patron) for patron in patron_data.values()]
+    object_bytes = sum(size[0] for size in sizes) / float(len(sizes))
+    total_bytes = sum(size[1] for size in sizes) / float(len(sizes))
+
+    print('%d rows loaded in %.2fs (%.0f rows/s)' % (options.rows, elapsed, options.rows / elapsed))
+    print('%.0f bytes per Patron object, %.0f bytes including attribute values' % (object_bytes,
+                                                                                   total_bytes))
+
+    return True
+
+
+def benchmark_zip_codes(work_folder, options):
+    """Compare the cost of classifying a row as distance or not against lists of ZIP codes of growing size."""
+    rng = random.Random(options.seed)
+    row_zip_codes = ['%05d' % rng.randint(0, 99999) for i in range(options.rows)]
+
+    for size in [10, 100, 1000, 10000]:
+        zip_codes = ['%05d' % zip_code for zip_code in rng.sample(range(100000), size)]
+        timings = []
+        for non_distance_zip_codes in [sorted(zip_codes), ZipCodes(zip_codes)]:
+            start = time.time()
+            for zip_code in row_zip_codes:
+                patronload.is_distance_zip_code(zip_code, non_distance_zip_codes)
+            timings.append((time.time() - start) / options.rows * 1000000)
+
+        print('%5d ZIP codes: %.2f us/row with a list, %.2f us/row with ZipCodes' % (size, timings[0],
+                                                                                       timings[1]))
+
+    return True
+
+
+def iter_user_elements(path):
+    """Yield the user elements of the XML files of a load, from a folder or a ZIP file."""
+    if zipfile.is_zipfile(path):
+        zip_file = zipfile.ZipFile(path)
+        xml_files = [zip_file.open(name) for name in sorted(zip_file.namelist())
+                     if name.endswith(patronload.OUTPUT_FILENAME_BASE)]
+    else:
+        xml_files = [open(os.path.join(path, filename), 'rb') for filename in sorted(os.listdir(path))
+                     if filename.endswith(patronload.OUTPUT_FILENAME_BASE)]
+
+    for xml_file in xml_files:
+        with xml_file:
+            for event, element in ElementTree.iterparse(xml_file):
+                if element.tag == 'user':
+                    # The whitespace after the last user of a file is not part of the record
+                    element.tail = None
+                    yield element
+                    element.clear()
+
+
+def load_user_records(path):
+    """Return the serialized user elements of a load, keyed by primary identifier."""
+    return dict((element.findtext('primary_id'), ElementTree.tostring(element))
+                for element in iter_user_elements(path))
+
+
+def benchmark_compare(work_folder, options):
+    """
+    Render an export with the current code and compare each record with the
+    XML files of another load, whatever the order of the records and the way
+    they are split into files. The run fails if any record differs.
+    """
+    if not options.input_file or not options.expected:
+        print('compare needs an export (-i) and the XML files to compare with (-x)')
+        return False
+
+    patron_data_file, zip_codes_file = prepare_patron_data(work_folder, options)
+    non_distance_zip_codes = patronload.load_zip_codes_file(zip_codes_file)
+    patron_data = patronload.load_patron_data_file(patron_data_file, non_distance_zip_codes)
+    output_folder = os.path.join(work_folder, 'output')
+    os.mkdir(output_folder)
+
+    writer = patronload.PatronFileWriter(OutputFolder(output_folder), engine=options.engine)
+    for patron_list in patronload.dict_chunks(patron_data, 10000):
+        writer.write(patron_list)
+    writer.close()
+
+    records = load_user_records(output_folder)
+    expected_records = load_user_records(options.expected)
+    different = sorted(barcode for barcode in records
+                       if barcode in expected_records and records[barcode] != expected_records[barcode])
+    missing = sorted(set(expected_records) - set(records))
+    unexpected = sorted(set(records) - set(expected_records))
+
+    print('%d records: %d identical, %d different, %d missing, %d unexpected' % (
+        len(records), len(records) - len(different) - len(unexpected), len(different), len(missing),
+        len(unexpected)))
+    for label, barcodes in [('Different', different), ('Missing', missing), ('Unexpected', unexpected)]:
+        if barcodes:
+            print('%s: %s' % (label, ' '.join(barcodes[:10]) + (' ...' if len(barcodes) > 10 else '')))
+
+    return not (different or missing or unexpected)
+
+
+def benchmark_ingest(work_folder, options):
+    """Measure the rows per second read from the export."""
+    patron_data_file, zip_codes_file = prepare_patron_data(work_folder, options)
+
+    elapsed = None
+    for run in range(INGEST_RUNS):
+        start = time.time()
+        rows = 0
+        for row in patronload.iter_patron_data_rows(patron_data_file):
+            rows += 1
+        elapsed = min(elapsed or float('inf'), time.time() - start)
+
+    print('%d rows read in %.2fs (%.0f rows/s)' % (rows, elapsed, rows / elapsed))
+
+    return True
+
+
+def startup_time(command):
+    """Return the best and median wall time of STARTUP_RUNS runs of a command."""
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for run in range(STARTUP_RUNS):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def benchmark_startup(work_folder, options):
+    """
+    Time how long the scripts take to start and print their help, next to the
+    bare interpreter. The interpreter and the folder holding the scripts can be
+    changed to compare with another version.
+    """
+    commands = [('interpreter', [options.python, '-c', 'pass'])]
+    for script in STARTUP_SCRIPTS:
+        commands.append((script, [options.python, os.path.join(options.checkout, script), '--help']))
+
+    for label, command in commands:
+        best, median = startup_time(command)
+        print('%-32s %7.1f ms best %7.1f ms median' % (label, best * 1000, median * 1000))
+
+    return True
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def step_result(rows, elapsed):
+    return {
+        'seconds': round(elapsed, 4),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def suite_size(work_folder, rows, options):
+    """Time the main steps of the load on a synthetic export of the given number of rows."""
+    size_folder = os.path.join(work_folder, str(rows))
+    os.mkdir(size_folder)
+    patron_data_file = os.path.join(size_folder, 'patrondata.csv')
+    previous_file = os.path.join(size_folder, 'patrondata-previous.csv')
+    generate_patron_data_file(patron_data_file, rows, options.seed, changes=0.05)
+    generate_patron_data_file(previous_file, rows, options.seed)
+    non_distance_zip_codes = patronload.load_zip_codes_file(write_reference_files(size_folder))
+    department_codes = patronload.load_department_codes_file(write_department_codes_file(size_folder))
+    results = {}
+
+    patron_data, elapsed = timed(patronload.load_patron_data_file, patron_data_file, non_distance_zip_codes)
+    results['load_patron_data_file'] = step_result(rows, elapsed)
+
+    new_department_codes, elapsed = timed(patronload.find_new_department_codes, department_codes, patron_data)
+    results['find_new_department_codes'] = step_result(len(patron_data), elapsed)
+
+    group_changes, elapsed = timed(patronload.find_patron_data_diffs, patron_data, previous_file,
+                                   non_distance_zip_codes)
+    results['find_patron_data_diffs'] = step_result(len(patron_data), elapsed)
+
+    # Same output as the nightly load, which writes straight into the SFTP ZIP file
+    start = time.time()
+    writer = patronload.PatronFileWriter(OutputZip(os.path.join(size_folder, 'userdata.zip')),
+                                         engine=options.engine)
+    for patron_list in patronload.dict_chunks(patron_data, 10000):
+        writer.write(patron_list)
+    record_count = writer.close()
+    results['render_write'] = step_result(record_count, time.time() - start)
+
+    for step in sorted(results):
+        print('%8d rows  %-26s %8.2fs %10s rows/s' % (rows, step, results[step]['seconds'],
+                                                       results[step]['rows_per_second']))
+    print('%8d rows  %d records, %d new department codes, %d group changes' % (
+        rows, len(patron_data), len(new_department_codes), len(group_changes)))
+
+    shutil.rmtree(size_folder)
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """Return the steps slower than in the baseline by more than the tolerance, as (size, step, ratio) tuples."""
+    regressions = []
+
+    for size, steps in sorted(results.items()):
+        for step, result in sorted(steps.items()):
+            baseline_result = baseline.get(size, {}).get(step)
+            if baseline_result is None or result['seconds'] < MIN_REGRESSION_SECONDS or \
+                    not baseline_result['seconds']:
+                continue
+            ratio = result['seconds'] / baseline_result['seconds']
+            if ratio > 1 + tolerance:
+                regressions.append((size, step, ratio))
+
+    return regressions
+
+
+def benchmark_suite(work_folder, options):
+    """Time the main steps of the load at several export sizes and compare them with a baseline."""
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = {}
+
+    for rows in sizes:
+        results[str(rows)] = suite_size(work_folder, rows, options)
+
+    report = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'seed': options.seed,
+        'engine': options.engine,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'results': results,
+    }
+    if options.results_file:
+        with open(options.results_file, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+            json_file.write('\n')
+
+    if options.baseline_file:
+        with open(options.baseline_file) as json_file:
+            baseline = json.load(json_file)['results']
+        regressions = find_regressions(results, baseline, options.tolerance)
+        for size, step, ratio in regressions:
+            print('REGRESSION: %s at %s rows is %.0f%% slower than the baseline' % (step, size,
+                                                                                  (ratio - 1) * 100))
+        if regressions:
+            return False
+        print('No regression against %s' % options.baseline_file)
+
+    return True
+
+
+BENCHMARKS = {
+    'compare': benchmark_compare,
+    'engines': benchmark_engines,
+    'ingest': benchmark_ingest,
+    'patrons': benchmark_patrons,
+    'startup': benchmark_startup,
+    'suite': benchmark_suite,
+    'workers': benchmark_workers,
+    'zipcodes': benchmark_zip_codes,
+}
+
+
+def main(argv):
+    usage = "usage: %prog [options] " + "|".join(sorted(BENCHMARKS))
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-b', '--baseline',
+                      help='Suite results file to compare the timings with',
+                      dest='baseline_file')
+    parser.add_option('--checkout',
+                      help='Folder of the scripts timed by startup (default: this folder)',
+                      default=os.path.dirname(os.path.realpath(__file__)),
+                      dest='checkout')
+    parser.add_option('-e', '--engine',
+                      help='XML output engine used by the suite and compare (default: jinja)',
+                      choices=['jinja', 'direct'],
+                      default='jinja',
+                      dest='engine')
+    parser.add_option('-i', '--input',
+                      help='Use the given patron data file instead of a synthetic export',
+                      dest='input_file')
+    parser.add_option('-n', '--rows',
+                      help='Number of rows in the synthetic export (default: 200000)',
+                      type='int',
+                      default=200000,
+                      dest='rows')
+    parser.add_option('-o', '--results',
+                      help='Write the suite results as JSON to RESULTS_FILE',
+                      dest='results_file')
+    parser.add_option('-p', '--python',
+                      help='Python interpreter timed by startup (default: the current one)',
+                      default=sys.executable,
+                      dest='python')
+    parser.add_option('-s', '--seed',
+                      help='Seed of the synthetic export generator',
+                      type='int',
+                      default=0,
+                      dest='seed')
+    parser.add_option('--sizes',
+                      help='Comma-separated export sizes of the suite (default: 10000,100000,1000000)',
+                      default='10000,100000,1000000',
+                      dest='sizes')
+    parser.add_option('-t', '--tolerance',
+                      help='Slowdown over the baseline reported as a regression (default: 0.25)',
+                      type='float',
+                      default=0.25,
+                      dest='tolerance')
+    parser.add_option('-w', '--workers',
+                      help='Comma-separated worker counts to compare (default: 1,2,4,8)',
+                      default='1,2,4,8',
+                      dest='workers')
+    parser.add_option('-x', '--expected',
+                      help='Folder or ZIP file of the XML files compared with by compare',
+                      dest='expected')
+    parser.add_option('-z', '--zip-codes',
+                      help='Non-distance ZIP codes file used with --input',
+                      dest='zip_codes_file')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error('Unknown benchmark.')
+
+    logging.basicConfig(level=logging.ERROR)
+    work_folder = tempfile.mkdtemp(prefix='patronload-benchmark-')
+
+    try:
+        if not BENCHMARKS[args[0]](work_folder, options):
+            sys.exit(1)
+    finally:
+        shutil.rmtree(work_folder)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,39 +1,151 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
-# Change group of an Alma user.
-# Argument is the user's primary identifier.
+# Change the group of Alma users.
+# Arguments are the users' primary identifiers. Identifiers can also be read
+# from a file (or stdin with '-f -'), one per line, optionally followed by the
+# group to assign to that user.
+#
+# With a journal, the result of each change is recorded under a run ID and the
+# changes already completed for that run ID are skipped, so an interrupted run
+# can simply be started again.
+#
+# Large batches can be written instead to a ZIP file of partial user XML files
+# for the SIS import, which changes all their groups in one job.
 #
 
-import os, requests, sys
-from bs4 import BeautifulSoup
+import logging, os, sys
+from collections import OrderedDict
+from datetime import date
 from optparse import OptionParser
 
+from almaapi import AlmaAPIError, AlmaUsersClient, DEFAULT_RATE_LIMIT
+from groupjournal import CHANGED, EXPORTED, FAILED, UNCHANGED, GroupChangeJournal, read_group_changes
+from instrumentation import RunReport
+from usercache import DEFAULT_TTL, UserCache
+
+
+def change_group(client, barcode, group_name):
+    """Return the barcode, group name, result, HTTP status, previous group and error message of a change."""
+    try:
+        previous_group, status_code, changed = client.change_group(barcode, group_name)
+        return barcode, group_name, CHANGED if changed else UNCHANGED, status_code, previous_group, None
+    except AlmaAPIError as error:
+        logging.warning(error)
+        return barcode, group_name, FAILED, error.status_code, None, str(error)
+    except Exception as error:
+        message = "Changing the group of %s failed: %s" % (barcode, error)
+        logging.warning(message)
+        return barcode, group_name, FAILED, None, None, message
+
 
-ALMA_API_BASE_URL = 'https://api-na.hosted.exlibrisgroup.com'
-ALMA_USERS_API_PATH = '/almaws/v1/users'
+def export_group_changes(changes, zip_path, cache=None):
+    """
+    Write the (barcode, group name) changes to a ZIP file of partial user XML files
+    for the SIS import and return their results. The cached records of the users
+    are invalidated, since the import changes them.
+    """
+    from outputfiles import OutputZip
+    from patronload import write_group_change_files
+
+    group_changes = OrderedDict(changes)
+    record_count = write_group_change_files(group_changes, OutputZip(zip_path))
+    logging.info("%s group changes written to %s." % (record_count, zip_path))
+
+    results = []
+    for barcode, group_name in group_changes.items():
+        if cache is not None:
+            cache.invalidate(barcode)
+        results.append((barcode, group_name, EXPORTED, None, None, None))
+
+    return results
 
-# Mandatory fields that are not primary identifiers
-MANDATORY_ADDRESS_FIELDS = [ 'line1', 'email' ]
 
 def main(argv):
-    usage = "usage: %prog [options] barcode"
+    usage = "usage: %prog [options] [barcode...]"
 
     parser = OptionParser(usage=usage)
+    parser.add_option(
+            '--bulk-output',
+            help='Write the changes to BULK_OUTPUT, a ZIP file of user XML for the SIS import, '
+                 'when there are at least --bulk-threshold of them',
+            dest='bulk_output'
+    )
+    parser.add_option(
+            '--bulk-threshold',
+            help='Smallest number of changes written to --bulk-output instead of made through the API '
+                 '(default: 1000)',
+            type='int',
+            default=1000,
+            dest='bulk_threshold'
+    )
+    parser.add_option(
+            '--cache',
+            help='Read user records through the CACHE file, invalidated when a user is updated',
+            dest='cache'
+    )
+    parser.add_option(
+            '--cache-ttl',
+            help='Seconds during which a cached user record is used without calling Alma; records are always '
+                 'revalidated before a change (default: %s)' % DEFAULT_TTL,
+            type='int',
+            default=DEFAULT_TTL,
+            dest='cache_ttl'
+    )
+    parser.add_option(
+            '-c', '--concurrency',
+            help='Number of users updated at the same time (default: 4)',
+            type='int',
+            default=4,
+            dest='concurrency'
+    )
+    parser.add_option(
+            '-f', '--file',
+            help='Read barcodes, and optionally groups, from FILE (- for stdin)',
+            dest='file'
+    )
     parser.add_option(
             '-g', '--group-name',
-            help='Assign the account to GROUP_NAME',
+            help='Assign the accounts to GROUP_NAME',
             default='expired',
             dest='group_name'
     )
     parser.add_option(
-            '-k', '--api-key', 
-            help='Alma API key', 
+            '-j', '--journal',
+            help='Record the result of each change in the JOURNAL file and skip the changes completed for the run ID',
+            dest='journal'
+    )
+    parser.add_option(
+            '-k', '--api-key',
+            help='Alma API key',
             dest='api_key'
     )
+    parser.add_option(
+            '--metrics',
+            help='Write the run report as Prometheus metrics to METRICS',
+            dest='metrics'
+    )
+    parser.add_option(
+            '--run-id',
+            help='ID of the run in the journal (default: today\'s date)',
+            default=date.today().isoformat(),
+            dest='run_id'
+    )
+    parser.add_option(
+            '--report',
+            help='Write the timings and results of the run as JSON to REPORT',
+            dest='report'
+    )
+    parser.add_option(
+            '-r', '--rate-limit',
+            help='Maximum number of API calls per second (default: %s)' % DEFAULT_RATE_LIMIT,
+            type='float',
+            default=DEFAULT_RATE_LIMIT,
+            dest='rate_limit'
+    )
     parser.add_option(
             '-v', '--verbose',
-            help='Verbose mode: display actions taken on the account',
+            help='Verbose mode: display actions taken on the accounts',
             action='store_true',
             default=False,
             dest='verbose'
@@ -41,48 +153,93 @@ def main(argv):
 
     (options, args) = parser.parse_args()
 
-    if len(args) != 1:
-        parser.error('Incorrect number of arguments.')
+    report = RunReport('change_patron_group', enabled=options.report is not None or options.metrics is not None)
 
-    barcode = args[0]
-    headers = { 'Authorization': 'apikey ' + options.api_key }
-    request_url = ALMA_API_BASE_URL + ALMA_USERS_API_PATH + '/' + barcode + '?override=user_group'
-    r = requests.get(request_url, headers=headers)
+    with report.stage('read'):
+        changes = read_group_changes(args, options.group_name)
+        if options.file == '-':
+            changes.extend(read_group_changes(sys.stdin, options.group_name))
+        elif options.file:
+            with open(options.file) as barcode_file:
+                changes.extend(read_group_changes(barcode_file, options.group_name))
 
-    if options.verbose:
-        print("HTTP Headers: %s" % headers)
-        print("HTTP Request: %s" % request_url)
-
-    soup = BeautifulSoup(r.text, features='xml')
-    user_group = soup.find('user_group').string
-
-    addresses = soup.find_all("address")
-    for address in addresses:
-        for field in MANDATORY_ADDRESS_FIELDS:
-            if field not in address.children:
-                if options.verbose:
-                    print("Field %s does not exist for %s. Adding it and assigning a filler value." % (field, barcode))
-                new_field = soup.new_tag(field)
-                new_field.string = "FILLER"
-                address.append(new_field)
+    if options.concurrency < 1:
+        parser.error('Concurrency must be a positive integer.')
 
     if options.verbose:
-        print("Reassigning patron with barcode '%s' to group '%s'" % (barcode, options.group_name))
-
-    tag = soup.new_tag('user_group')
-    tag.string = options.group_name
-    soup.find('user_group').replace_with(tag)
-
-    xml = str(soup)
-    if options.verbose:
-        print("XML string to send: %s" % soup.prettify())
-
-    headers = { 'Authorization': 'apikey ' + options.api_key, 'Content-Type': 'application/xml' }
-    r = requests.put(request_url, data=xml, headers=headers).text
-    if options.verbose:
-        print(r)
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    if options.journal:
+        journal = GroupChangeJournal(options.journal)
+        journal.prune()
+        pending = journal.plan(options.run_id, changes)
+        if len(pending) < len(changes):
+            logging.info("Skipping %s changes completed in run %s." % (len(changes) - len(pending), options.run_id))
+        report.count('users_skipped', len(changes) - len(pending))
+    else:
+        journal = None
+        pending = changes
+
+    if options.cache:
+        cache = UserCache(options.cache, options.cache_ttl)
+    else:
+        cache = None
+
+    bulk = options.bulk_output is not None and len(pending) > 0 and len(pending) >= options.bulk_threshold
+    client = pool = None
+    if bulk:
+        # A file not yet picked up by the SIS import is never replaced
+        if os.path.exists(options.bulk_output):
+            parser.error('%s already exists.' % options.bulk_output)
+    elif pending:
+        if options.api_key is None:
+            parser.error('Alma API key missing.')
+        client = AlmaUsersClient(options.api_key, cache=cache, rate_limit=options.rate_limit,
+                                 pool_size=options.concurrency)
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(options.concurrency)
+    counts = { CHANGED: 0, UNCHANGED: 0, EXPORTED: 0, FAILED: 0 }
+
+    try:
+        if bulk:
+            with report.stage('export', len(pending)):
+                results = export_group_changes(pending, options.bulk_output, cache)
+        elif pending:
+            results = pool.imap(lambda change: change_group(client, change[0], change[1]), pending)
+        else:
+            # Nothing left to change, e.g. a run resumed after all its changes were made
+            results = []
+        for barcode, group_name, result, status_code, previous_group, message in report.timed('change', results):
+            if journal is not None:
+                journal.record(options.run_id, barcode, group_name, result, status_code, previous_group, message)
+            print("%s\t%s\t%s\t%s\t%s" % (barcode, group_name, result, '' if status_code is None else status_code,
+                                            previous_group or ''))
+            report.count('users_' + result)
+            counts[result] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            client.close()
+        if journal is not None:
+            journal.close()
+        if cache is not None:
+            logging.info("User cache: %s hits, %s revalidated, %s misses." % (cache.hits, cache.revalidations,
+                                                                             cache.misses))
+            report.count('cache_hits', cache.hits)
+            report.count('cache_revalidations', cache.revalidations)
+            report.count('cache_misses', cache.misses)
+            cache.close()
+
+    sys.stderr.write("%s users processed, %s changed, %s already in their group, %s exported, %s skipped, "
+                     "%s failed.\n" % (len(changes), counts[CHANGED], counts[UNCHANGED], counts[EXPORTED],
+                                       len(changes) - len(pending), counts[FAILED]))
+    report.write(options.report, options.metrics)
+    if counts[FAILED]:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     main(sys.argv)
-
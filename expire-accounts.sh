@@ -7,11 +7,21 @@ APPHOME=${PWD}
 ## Load process configuration files
 . config/patronload.config
 
+# Submit the Python scripts to the job server when it is running
+if venv/bin/python patronloadd.py ping > /dev/null 2>&1; then
+        python_run="venv/bin/python patronloadd.py run"
+else
+        python_run="venv/bin/python"
+fi
+
 if [ ! -d $config_tempfolder ]; then
         mkdir $config_tempfolder
 fi
 
-declare -A affected_users
+if [ ! -d $config_previous_folder ]; then
+        mkdir $config_previous_folder
+fi
+
 patron_group="${config_expired_patrons_group}"
 
 if [[ $config_debug ]]; then
@@ -23,32 +33,31 @@ if [[ $config_debug ]]; then
         echo "Processing expirations (`date`)..."
 fi
 
-venv/bin/python fetch-analytics-report-data.py -k ${config_alma_analitycs_api_key} -p ${config_alma_analytics_expired_patrons_report_path} -f ${config_alma_analytics_report_barcode_field} > $config_tempfolder/$config_alma_to_be_expired_patrons_list
-for barcode in `grep -E ^9[0-9]{8} $config_tempfolder/$config_alma_to_be_expired_patrons_list`; do
-        if [[ $config_do_expirations ]]; then
-                venv/bin/python change-patron-group.py -g ${patron_group} -k ${config_alma_analitycs_api_key} ${barcode}
-        else
-                echo "venv/bin/python change-patron-group.py -g ${patron_group} -k ${config_alma_analitycs_api_key} ${barcode}"
-        fi
-        affected_users[$barcode]=$patron_group
-done
+$python_run fetch-analytics-report-data.py -k ${config_alma_analitycs_api_key} -p ${config_alma_analytics_expired_patrons_report_path} -f ${config_alma_analytics_report_barcode_field} > $config_tempfolder/$config_alma_to_be_expired_patrons_list
+grep -E ^9[0-9]{8} $config_tempfolder/$config_alma_to_be_expired_patrons_list > $config_tempfolder/$config_alma_expirations_list
+
+# Large batches of changes are left to the dedicated SIS import profile, when there is one
+bulk_options=""
+if [[ $config_group_change_sftplocation ]]; then
+        bulk_options="--bulk-output $config_group_change_sftplocation/$config_expirations_zipfilename --bulk-threshold $config_group_change_bulk_threshold"
+fi
+
+if [[ $config_do_expirations ]]; then
+        $python_run change-patron-group.py -j $config_previous_folder/$config_group_change_journal --cache $config_previous_folder/$config_user_cache $bulk_options --run-id expire-$(date +"%Y%m%d") -g ${patron_group} -k ${config_alma_analitycs_api_key} -f $config_tempfolder/$config_alma_expirations_list
+else
+        echo "$python_run change-patron-group.py -j $config_previous_folder/$config_group_change_journal --cache $config_previous_folder/$config_user_cache $bulk_options --run-id expire-$(date +"%Y%m%d") -g ${patron_group} -k ${config_alma_analitycs_api_key} -f $config_tempfolder/$config_alma_expirations_list"
+fi
 
 if [[ $config_debug ]]; then
-        echo "${#affected_users[@]} users were expired."
+        echo "`grep -c . $config_tempfolder/$config_alma_expirations_list` users were expired."
 fi
 
 # Send expirations notice
-if [[ ${#affected_users[@]} != 0 ]]; then
-        declare message_body
-        for key in "${!affected_users[@]}"; do
-                message_body=$(printf "%s\nAssigning patron with barcode %s to group %s\n" "$message_body" "$key" "${affected_users[$key]}")
-        done
-        if [[ $config_send_expiration_notice ]]; then
-                printf "%s\n" "${message_body}" | /bin/mail -s "${config_expirations_notice_subject}" $config_expirations_notice_recipient
-        else
-                echo "Not sending expirations notice."
-                printf "%s\n" "${message_body}" >&2
-        fi
+if [[ $config_send_expiration_notice ]]; then
+        $python_run notify.py -s "${config_expirations_notice_subject}" -r $config_expirations_notice_recipient -g ${patron_group} -e $config_tempfolder/$config_alma_expirations_list
+else
+        echo "Not sending expirations notice."
+        $python_run notify.py -n -s "${config_expirations_notice_subject}" -g ${patron_group} -e $config_tempfolder/$config_alma_expirations_list
 fi
 
 if [[ $config_debug ]]; then
@@ -37,10 +37,16 @@ def deploy():
                 remote_dir='{0}'.format(env.app_dir),
                 local_dir='./',
                 exclude=('*.pyc', '*.md', '.git*', '*.swp', 'fabfile.py', 'venv', 'tmp', 
-                    'sftp', 'archived', 'config/patronload.config.example', '.vscode'),)
+                    'sftp', 'archived', 'config/patronload.config.example', '.vscode', 'tests'),)
         with cd('{0}'.format(env.app_dir)):
             if run('test -d venv').failed:
-                run('virtualenv venv -p /usr/bin/python2.7')
+                run('python3 -m venv venv')
             with source_virtualenv():
                 run('pip install -r requirements.txt')
+            # A running job server keeps the scripts it loaded: restart it once its queued jobs
+            # have run, so that the next jobs run the code deployed
+            if run('venv/bin/python patronloadd.py ping', quiet=True).succeeded:
+                run('venv/bin/python patronloadd.py shutdown')
+                run('while [ -S run/patronloadd.sock ]; do sleep 1; done')
+                run('nohup venv/bin/python patronloadd.py serve >> run/patronloadd.log 2>&1 &', pty=False)
 
@@ -1,51 +1,101 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # -*- coding: utf-8 -*-
+#
+# Print the rows of an Alma Analytics report as they are fetched.
+#
+# Output formats:
+#   barcodes: the value of the barcode field of each row
+#   csv: the selected columns of each row, with a header line
+#   jsonl: one JSON object of the selected columns per row
+#
 
-import requests, sys
-from bs4 import BeautifulSoup
+import csv, json, sys
 from optparse import OptionParser
 
+from almaapi import ALMA_ANALYTICS_API_LIMIT, ALMA_ANALYTICS_API_MIN_LIMIT, AlmaAnalyticsClient
+from instrumentation import RunReport
 
-ALMA_API_BASE_URL='https://api-na.hosted.exlibrisgroup.com'
-ALMA_ANALYTICS_API_LIMIT='1000'
+
+OUTPUT_FORMATS = ['barcodes', 'csv', 'jsonl']
 
 
 def main(argv):
     usage = "usage: %prog [options]"
 
     parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--columns',
+                      help='Comma-separated report columns to output in csv and jsonl formats (default: all)',
+                      dest='columns')
     parser.add_option('-f', '--barcode-field',
                       help='Analytics report barcode field',
                       dest='barcode_field')
-    parser.add_option('-k', '--api-key', 
-                      help='Alma API key', 
+    parser.add_option('-k', '--api-key',
+                      help='Alma API key',
                       dest='api_key')
-    parser.add_option('-p', '--analytics-report-path', 
-                      help='Path to Alma Analitycs report', 
+    parser.add_option('-l', '--page-size',
+                      help='Number of rows fetched per request, between %s and %s (default: %s)' % (
+                          ALMA_ANALYTICS_API_MIN_LIMIT, ALMA_ANALYTICS_API_LIMIT, ALMA_ANALYTICS_API_LIMIT),
+                      type='int',
+                      default=ALMA_ANALYTICS_API_LIMIT,
+                      dest='page_size')
+    parser.add_option('--metrics',
+                      help='Write the run report as Prometheus metrics to METRICS',
+                      dest='metrics')
+    parser.add_option('-o', '--output-format',
+                      help='Output format: %s (default: barcodes)' % ', '.join(OUTPUT_FORMATS),
+                      choices=OUTPUT_FORMATS,
+                      default='barcodes',
+                      dest='output_format')
+    parser.add_option('-p', '--analytics-report-path',
+                      help='Path to Alma Analitycs report',
                       dest='analytics_report_path')
+    parser.add_option('--report',
+                      help='Write the timings of the run as JSON to REPORT',
+                      dest='report')
 
-    try:
-        (options, args) = parser.parse_args()
-
-        request_url = ALMA_API_BASE_URL + options.analytics_report_path + "&apikey=" + options.api_key + "&limit=" + ALMA_ANALYTICS_API_LIMIT 
-        finished = False
-
-        while not finished:
-            r = requests.get(request_url)
-            soup = BeautifulSoup(r.text, features='xml')
-            for barcode in soup.find_all(options.barcode_field):
-                print barcode.string
-            resume_token = soup.find('ResumptionToken')
-            if resume_token is not None:
-                request_url = request_url + "&token=" + resume_token.string
-            if soup.find('IsFinished').string == 'true':
-                    finished = True
-
-    except TypeError:
+    (options, args) = parser.parse_args()
+
+    if options.api_key is None or options.analytics_report_path is None or \
+            (options.output_format == 'barcodes' and options.barcode_field is None):
         parser.print_help()
         sys.exit(2)
 
+    if not ALMA_ANALYTICS_API_MIN_LIMIT <= options.page_size <= ALMA_ANALYTICS_API_LIMIT:
+        parser.error('The page size must be between %s and %s.' % (ALMA_ANALYTICS_API_MIN_LIMIT,
+                                                                  ALMA_ANALYTICS_API_LIMIT))
+
+    if options.columns:
+        columns = options.columns.split(',')
+    else:
+        columns = None
+
+    report = RunReport('fetch_analytics_report', enabled=options.report is not None or options.metrics is not None)
+    client = AlmaAnalyticsClient(options.api_key, page_size=options.page_size)
+    csv_writer = None
+
+    try:
+        for row in report.timed('fetch', client.iter_report(options.analytics_report_path)):
+            if options.output_format == 'barcodes':
+                if options.barcode_field in row:
+                    print(row[options.barcode_field])
+                continue
+
+            if columns is None:
+                columns = list(row.keys())
+            values = [row.get(column, '') for column in columns]
+
+            if options.output_format == 'csv':
+                if csv_writer is None:
+                    csv_writer = csv.writer(sys.stdout)
+                    csv_writer.writerow(columns)
+                csv_writer.writerow(values)
+            else:
+                print(json.dumps(dict(zip(columns, values)), sort_keys=True))
+    finally:
+        client.close()
+
+    report.write(options.report, options.metrics)
+
 
 if __name__ == "__main__":
     main(sys.argv)
-
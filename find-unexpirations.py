@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Find the group that expired Alma users should be moved back to.
+# Reads barcodes from the given file (or stdin) and prints the barcode and
+# group of each one found in the Banner patron data file, in the format
+# read by change-patron-group.py.
+#
+
+import logging, sys
+from optparse import OptionParser
+
+from patronload import load_patron_groups
+from referencedata import load_reference_file, load_zip_codes_file
+
+
+def main(argv):
+    usage = "usage: %prog [options] [barcode file]"
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-b', '--patron-data-file',
+                      help='Banner patron data file',
+                      dest='patron_data_file')
+    parser.add_option('-v', '--verbose',
+                      help='Verbose mode: report the barcodes that were not found',
+                      action='store_true',
+                      default=False,
+                      dest='verbose')
+    parser.add_option('-z', '--zip-codes-file',
+                      help='Non-distance ZIP codes file',
+                      dest='zip_codes_file')
+
+    (options, args) = parser.parse_args()
+
+    if options.patron_data_file is None or options.zip_codes_file is None or len(args) > 1:
+        parser.print_help()
+        sys.exit(2)
+
+    if options.verbose:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARN)
+
+    if args:
+        with open(args[0]) as barcode_file:
+            barcodes = [line.strip() for line in barcode_file if line.strip()]
+    else:
+        barcodes = [line.strip() for line in sys.stdin if line.strip()]
+
+    non_distance_zip_codes = load_reference_file(load_zip_codes_file, options.zip_codes_file)
+    patron_groups = load_patron_groups(options.patron_data_file, non_distance_zip_codes, set(barcodes))
+
+    for barcode in barcodes:
+        if barcode in patron_groups:
+            print("%s %s" % (barcode, patron_groups[barcode]))
+        else:
+            logging.info("No group found for barcode %s" % barcode)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Journal of the group changes made by change-patron-group.py, kept in a local
+# SQLite database. Each barcode of a run is recorded with the group planned
+# for it, the result of the change and the HTTP status, so that a run that was
+# interrupted can be started again without repeating the changes already made.
+#
+# The lists of group changes given to change-patron-group.py, and reported by
+# notify.py, are read with read_group_changes.
+#
+
+import logging
+import re
+import sqlite3
+import sys
+
+from datetime import date, datetime, timedelta
+from optparse import OptionParser
+
+
+# Runs are deleted from the journal after this many days
+RETENTION_DAYS = 90
+
+# Results of a group change. Completed changes are skipped when a run is resumed.
+# Exported changes were written to a bulk import file instead of made through the API.
+PLANNED = 'planned'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+EXPORTED = 'exported'
+FAILED = 'failed'
+COMPLETED_RESULTS = (CHANGED, UNCHANGED, EXPORTED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS group_changes (
+    run_id TEXT NOT NULL,
+    barcode TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    result TEXT NOT NULL,
+    status_code INTEGER,
+    previous_group TEXT,
+    message TEXT,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (run_id, barcode)
+);
+CREATE INDEX IF NOT EXISTS group_changes_updated ON group_changes (updated);
+"""
+
+
+def read_group_changes(lines, default_group):
+    """
+    Return the (barcode, group name) changes listed in lines, one per line with
+    the group optionally following the barcode after a space or a comma.
+    """
+    changes = []
+
+    for line in lines:
+        fields = re.split(r'[\s,]+', line.strip())
+        if fields[0] == '':
+            continue
+        if len(fields) > 1:
+            changes.append((fields[0], fields[1]))
+        else:
+            changes.append((fields[0], default_group))
+
+    return changes
+
+
+class GroupChangeJournal:
+    """
+    Journal of the group changes of each run, identified by a run ID.
+
+    Every result is committed as soon as it is recorded, so the journal is up
+    to date whenever the process is killed. Several processes can share the
+    journal; writes wait for each other.
+    """
+
+    def __init__(self, file_path, timeout=30):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def plan(self, run_id, changes):
+        """
+        Record the (barcode, group name) changes of a run and return the ones that
+        are not completed yet. A change completed for another group is planned again.
+        """
+        completed = dict(self.connection.execute(
+            "SELECT barcode, group_name FROM group_changes WHERE run_id = ? AND result IN (?, ?, ?)",
+            (run_id,) + COMPLETED_RESULTS))
+        pending = [(barcode, group_name) for barcode, group_name in changes
+                   if completed.get(barcode) != group_name]
+
+        now = datetime.now().isoformat()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO group_changes (run_id, barcode, group_name, result, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(run_id, barcode, group_name, PLANNED, now) for barcode, group_name in pending])
+
+        return pending
+
+    def record(self, run_id, barcode, group_name, result, status_code=None, previous_group=None, message=None):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO group_changes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, barcode, group_name, result, status_code, previous_group, message,
+                 datetime.now().isoformat()))
+
+    def get_changes(self, run_id, result=None):
+        """Return the (barcode, group name, result, status code, previous group, message) of a run."""
+        query = "SELECT barcode, group_name, result, status_code, previous_group, message " \
+                "FROM group_changes WHERE run_id = ?"
+        parameters = (run_id,)
+        if result is not None:
+            query += " AND result = ?"
+            parameters += (result,)
+
+        return self.connection.execute(query + " ORDER BY barcode", parameters).fetchall()
+
+    def get_runs(self):
+        """Return the ID, number of changes of each result and last update of every run."""
+        cursor = self.connection.execute(
+            "SELECT run_id, "
+            "SUM(result = ?), SUM(result = ?), SUM(result = ?), SUM(result = ?), SUM(result = ?), MAX(updated) "
+            "FROM group_changes GROUP BY run_id ORDER BY MAX(updated)",
+            (PLANNED, CHANGED, UNCHANGED, EXPORTED, FAILED))
+        return cursor.fetchall()
+
+    def prune(self, retention_days=RETENTION_DAYS):
+        """Delete the runs last updated more than retention_days ago."""
+        cutoff = (date.today() - timedelta(days=retention_days)).isoformat()
+        with self.connection:
+            deleted = self.connection.execute(
+                "DELETE FROM group_changes WHERE run_id IN "
+                "(SELECT run_id FROM group_changes GROUP BY run_id HAVING MAX(updated) < ?)",
+                (cutoff,)).rowcount
+        if deleted:
+            logging.info("Deleted %s group changes older than %s from %s." % (deleted, cutoff, self.file_path))
+
+        return deleted
+
+
+def main(argv):
+    usage = "usage: %prog [options] runs | show RUN_ID | failed RUN_ID"
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--file',
+                      help='Journal file',
+                      dest='file_path')
+
+    (options, args) = parser.parse_args()
+
+    if options.file_path is None or len(args) == 0:
+        parser.error('Journal file or command missing.')
+
+    journal = GroupChangeJournal(options.file_path)
+    command = args[0]
+
+    try:
+        if command == 'runs':
+            print('run_id\tplanned\tchanged\tunchanged\texported\tfailed\tupdated')
+            for row in journal.get_runs():
+                print('\t'.join('%s' % value for value in row))
+        elif command == 'show' and len(args) == 2:
+            for row in journal.get_changes(args[1]):
+                print('\t'.join('' if value is None else '%s' % value for value in row))
+        elif command == 'failed' and len(args) == 2:
+            # Same format as the input of change-patron-group.py
+            for row in journal.get_changes(args[1], FAILED):
+                print('%s %s' % (row[0], row[1]))
+        else:
+            parser.error('Unknown command.')
+    finally:
+        journal.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
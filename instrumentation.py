@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#
+# Run reports: wall time, CPU time, peak RSS and row counts for each stage of a
+# script, counts of rejected rows by reason, and other counters. A report is
+# written as JSON and, optionally, as Prometheus metrics for the node
+# exporter's textfile collector.
+#
+# Time is charged to the innermost active stage, so the stages of a pipeline
+# of generators each get the time spent in their own code rather than the
+# time spent pulling records through the whole pipeline.
+#
+
+import json
+import os
+import resource
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+METRICS_PREFIX = 'patronload'
+
+
+def cpu_time(times=None):
+    times = times or os.times()
+    return times[0] + times[1]
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.rows = 0
+        self.peak_rss = 0
+
+    def as_dict(self):
+        if self.wall_time > 0:
+            rows_per_second = round(self.rows / self.wall_time, 1)
+        else:
+            rows_per_second = None
+
+        return OrderedDict([
+            ('name', self.name),
+            ('wall_seconds', round(self.wall_time, 6)),
+            ('cpu_seconds', round(self.cpu_time, 6)),
+            ('rows', self.rows),
+            ('rows_per_second', rows_per_second),
+            ('peak_rss_bytes', self.peak_rss),
+        ])
+
+
+class RunReport:
+    """
+    Timings and counters of one run of a script.
+
+    A disabled report keeps counters but does not time anything, so that the
+    stages can be left in place at no cost when no report is requested.
+    """
+
+    def __init__(self, script, enabled=True):
+        self.script = script
+        self.enabled = enabled
+        self.started = time.time()
+        self.start_cpu_time = cpu_time()
+        self.stages = OrderedDict()
+        self.rejects = OrderedDict()
+        self.counters = OrderedDict()
+        self.active = []
+        self.last_wall_time = self.started
+        self.last_cpu_time = self.start_cpu_time
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def switch(self):
+        """Charge the time elapsed since the last switch to the innermost active stage."""
+        now = time.time()
+        now_cpu_time = cpu_time()
+        if self.active:
+            stage = self.active[-1]
+            stage.wall_time += now - self.last_wall_time
+            stage.cpu_time += now_cpu_time - self.last_cpu_time
+        self.last_wall_time = now
+        self.last_cpu_time = now_cpu_time
+
+    def enter(self, stage):
+        self.switch()
+        self.active.append(stage)
+
+    def leave(self):
+        self.switch()
+        self.active.pop()
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        stage = self.get_stage(name)
+        stage.rows += rows
+        if not self.enabled:
+            yield stage
+            return
+
+        self.enter(stage)
+        try:
+            yield stage
+        finally:
+            self.leave()
+            stage.peak_rss = peak_rss()
+
+    def timed(self, name, iterable):
+        """Yield the items of iterable, timing the production of each item as the named stage."""
+        if not self.enabled:
+            return iterable
+        return self.iter_timed(self.get_stage(name), iterable)
+
+    def iter_timed(self, stage, iterable):
+        iterator = iter(iterable)
+
+        try:
+            while True:
+                self.enter(stage)
+                try:
+                    item = next(iterator)
+                finally:
+                    self.leave()
+                stage.rows += 1
+                yield item
+        except StopIteration:
+            pass
+        finally:
+            stage.peak_rss = peak_rss()
+
+    def reject(self, reason):
+        self.rejects[reason] = self.rejects.get(reason, 0) + 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        now = time.time()
+        children_times = os.times()[2:4]
+
+        return OrderedDict([
+            ('script', self.script),
+            ('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+            ('wall_seconds', round(now - self.started, 6)),
+            ('cpu_seconds', round(cpu_time() - self.start_cpu_time, 6)),
+            ('children_cpu_seconds', round(sum(children_times), 6)),
+            ('peak_rss_bytes', peak_rss()),
+            ('children_peak_rss_bytes', peak_rss(resource.RUSAGE_CHILDREN)),
+            ('stages', [stage.as_dict() for stage in self.stages.values()]),
+            ('rejected_rows', self.rejects),
+            ('counters', self.counters),
+        ])
+
+    def write_json(self, file_path):
+        with open(file_path, 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=2)
+            json_file.write('\n')
+
+    def metrics(self):
+        """Return the report as lines of Prometheus text exposition format."""
+        report = self.as_dict()
+        script = 'script="%s"' % self.script
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (METRICS_PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s gauge' % (METRICS_PREFIX, name))
+            for labels, value in samples:
+                lines.append('%s_%s{%s} %s' % (METRICS_PREFIX, name, labels, value))
+
+        metric('run_timestamp_seconds', 'Start time of the last run.', [(script, int(self.started))])
+        metric('run_wall_seconds', 'Wall time of the last run.', [(script, report['wall_seconds'])])
+        metric('run_cpu_seconds', 'CPU time of the last run, including child processes.',
+               [(script, report['cpu_seconds'] + report['children_cpu_seconds'])])
+        metric('run_peak_rss_bytes', 'Peak resident set size of the last run.', [(script, report['peak_rss_bytes'])])
+
+        stages = report['stages']
+        stage_labels = ['%s,stage="%s"' % (script, stage['name']) for stage in stages]
+        for key, name, help_text in [('wall_seconds', 'stage_wall_seconds', 'Wall time of each stage.'),
+                                     ('cpu_seconds', 'stage_cpu_seconds', 'CPU time of each stage.'),
+                                     ('rows', 'stage_rows', 'Rows processed by each stage.'),
+                                     ('peak_rss_bytes', 'stage_peak_rss_bytes',
+                                      'Peak resident set size at the end of each stage.')]:
+            if stages:
+                metric(name, help_text, [(labels, stage[key]) for labels, stage in zip(stage_labels, stages)])
+
+        if self.rejects:
+            metric('rejected_rows', 'Rows rejected in the last run, by reason.',
+                   [('%s,reason="%s"' % (script, reason), count) for reason, count in self.rejects.items()])
+        if self.counters:
+            metric('count', 'Counters of the last run.',
+                   [('%s,name="%s"' % (script, name), count) for name, count in self.counters.items()])
+
+        return lines
+
+    def write_metrics(self, file_path):
+        # Written under a temporary name so that the collector never reads a partial file
+        temporary_path = file_path + '.part'
+        with open(temporary_path, 'w') as metrics_file:
+            for line in self.metrics():
+                metrics_file.write(line + '\n')
+        os.rename(temporary_path, file_path)
+
+    def write(self, report_file=None, metrics_file=None):
+        if report_file is not None:
+            self.write_json(report_file)
+        if metrics_file is not None:
+            self.write_metrics(metrics_file)
@@ -0,0 +1,177 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Email notices of the patron load scripts. The events of a run (new department
+# codes, rejected rows, name issues, expirations, unexpirations) are collected
+# into one digest, sent by a background thread over a single SMTP connection
+# so that the script does not wait for the mail server.
+#
+# Run as a script, it sends the digest of the group changes listed in files in
+# the format read by change-patron-group.py.
+#
+
+import logging
+import queue
+import smtplib
+import sys
+import threading
+
+from collections import OrderedDict
+from email.mime.text import MIMEText
+from optparse import OptionParser
+
+from groupjournal import read_group_changes
+
+
+RETURN_ADDRESS = 'Patron Load <patronload@www.lib.pdx.edu>'
+SMTP_HOST = "mailhost.pdx.edu"
+SMTP_TIMEOUT = 60
+
+
+class Digest:
+    """Lines of text grouped by section, sent as one message."""
+
+    def __init__(self, subject):
+        self.subject = subject
+        self.sections = OrderedDict()
+
+    def add(self, title, lines):
+        lines = list(lines)
+        if lines:
+            self.sections.setdefault(title, []).extend(lines)
+
+    def __len__(self):
+        return sum(len(lines) for lines in self.sections.values())
+
+    def text(self):
+        parts = []
+        for title, lines in self.sections.items():
+            parts.append('%s (%s)\n\n%s\n' % (title, len(lines), '\n'.join(lines)))
+        return '\n'.join(parts)
+
+    def message(self, recipients, return_address=RETURN_ADDRESS):
+        message = MIMEText(self.text())
+        message['Subject'] = self.subject
+        message['From'] = return_address
+        message['To'] = ', '.join(recipients)
+        return message
+
+
+class Notifier:
+    """
+    Send messages from a background thread. The SMTP connection is opened for the
+    first message and reused for the next ones; it is opened again if the server
+    closed it in between. close() waits until every message is sent.
+    """
+
+    def __init__(self, host=SMTP_HOST, timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.timeout = timeout
+        self.connection = None
+        self.sent = self.failed = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='notifier')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, message):
+        self.queue.put(message)
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self.deliver(message)
+                self.sent += 1
+            except (smtplib.SMTPException, OSError) as error:
+                logging.warning("Sending '%s' failed: %s" % (message['Subject'], error))
+                self.failed += 1
+                self.disconnect()
+
+        self.disconnect()
+
+    def deliver(self, message):
+        if self.connection is not None:
+            try:
+                self.connection.send_message(message)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.connection = None
+
+        self.connection = smtplib.SMTP(self.host, timeout=self.timeout)
+        self.connection.send_message(message)
+
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def main(argv):
+    usage = "usage: %prog [options] -s SUBJECT -r RECIPIENTS"
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-e', '--expirations',
+                      help='Barcodes, optionally followed by a group, of the users expired',
+                      dest='expirations')
+    parser.add_option('-g', '--group-name',
+                      help='Group of the barcodes listed without one (default: expired)',
+                      default='expired',
+                      dest='group_name')
+    parser.add_option('-n', '--dry-run',
+                      help='Write the digest to stderr instead of sending it',
+                      action='store_true',
+                      default=False,
+                      dest='dry_run')
+    parser.add_option('-r', '--recipients',
+                      help='Comma-separated list of recipients',
+                      dest='recipients')
+    parser.add_option('-s', '--subject',
+                      help='Subject of the digest',
+                      dest='subject')
+    parser.add_option('--smtp-host',
+                      help='SMTP server (default: %s)' % SMTP_HOST,
+                      default=SMTP_HOST,
+                      dest='smtp_host')
+    parser.add_option('-u', '--unexpirations',
+                      help='Barcodes, optionally followed by a group, of the users unexpired',
+                      dest='unexpirations')
+
+    (options, args) = parser.parse_args()
+
+    if options.subject is None or (options.recipients is None and not options.dry_run):
+        parser.error('Subject or recipients missing.')
+
+    logging.basicConfig(level=logging.WARN)
+
+    digest = Digest(options.subject)
+    for title, file_path in [('Expirations', options.expirations), ('Unexpirations', options.unexpirations)]:
+        if file_path is not None:
+            with open(file_path) as changes_file:
+                changes = read_group_changes(changes_file, options.group_name)
+            digest.add(title, ('Assigning patron with barcode %s to group %s' % change for change in changes))
+
+    if len(digest) == 0:
+        return
+    if options.dry_run:
+        sys.stderr.write(digest.text())
+        return
+
+    notifier = Notifier(options.smtp_host)
+    notifier.send(digest.message(options.recipients.split(',')))
+    notifier.close()
+    if notifier.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Destinations for the XML files generated by the patron load: a folder, or a
+# ZIP file written directly in its final location. Each file written is
+# counted and checksummed for the load's manifest.
+#
+
+import csv
+import hashlib
+import os
+import zipfile
+
+
+class ChecksumWriter:
+    """Binary file wrapper that keeps the size and SHA-256 digest of the data written."""
+
+    def __init__(self, output_file, filename, manifest, record_count):
+        self.output_file = output_file
+        self.filename = filename
+        self.manifest = manifest
+        self.record_count = record_count
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self.digest.update(data)
+        self.output_file.write(data)
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def close(self):
+        self.output_file.close()
+        self.manifest.append((self.filename, self.record_count, self.size, self.digest.hexdigest()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class OutputFolder:
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.manifest = []
+
+    def open(self, filename, record_count):
+        output_file = open(os.path.join(self.folder_path, filename), 'wb')
+        return ChecksumWriter(output_file, filename, self.manifest, record_count)
+
+    def close(self):
+        pass
+
+
+class OutputZip:
+    """
+    Files compressed into a ZIP archive. The archive is written under a temporary
+    name and moved to its final path when closed, so a partial archive is never
+    picked up from the destination.
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.temporary_path = zip_path + '.part'
+        self.zip_file = zipfile.ZipFile(self.temporary_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.manifest = []
+
+    def open(self, filename, record_count):
+        # Compressed as it is written; only one file can be open at a time
+        return ChecksumWriter(self.zip_file.open(filename, 'w'), filename, self.manifest, record_count)
+
+    def close(self):
+        self.zip_file.close()
+        os.rename(self.temporary_path, self.zip_path)
+
+
+def write_manifest(file_path, manifest):
+    with open(file_path, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(['filename', 'records', 'bytes', 'sha256'])
+        for row in manifest:
+            csv_writer.writerow(row)
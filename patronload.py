@@ -1,27 +1,33 @@
-#! /usr/bin/env python2.7
+#! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import codecs
+import csv
 import getopt
+import hashlib
+import io
 import logging
 import os
 import sys
 import re
-import unicodecsv
-import csv
-import smtplib
+import zlib
 
-from datetime import date, datetime, timedelta
-from email.mime.text import MIMEText
+from collections import OrderedDict, deque
+from datetime import date, timedelta
+from instrumentation import RunReport
 from itertools import islice
-from jinja2 import Environment, FileSystemLoader
-from xml.sax.saxutils import escape
+from outputfiles import OutputFolder, OutputZip, write_manifest
+from referencedata import load_department_codes_file, load_reference_file, load_zip_codes_file
 
 
 # Input
-CURRENT_PATRON_DATA_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 
-                                        "tmp", 
-                                        "patrondata-" + date.today().strftime("%Y%m%d") + ".csv")
+def current_patron_data_file(today=None):
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        "tmp",
+                        "patrondata-" + (today or date.today()).strftime("%Y%m%d") + ".csv")
+
+CURRENT_PATRON_DATA_FILE = current_patron_data_file()
+# Load date in the name of a patron data file
+PATRON_DATA_FILE_DATE = re.compile(r'patrondata-(\d{4})(\d{2})(\d{2})')
 DEPARTMENTS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 "tmp", "departments.csv")
 ZIP_CODES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -34,12 +40,64 @@ TEMPLATE_FILENAME = "userdata-template.xml"
 # Ouptut
 OUTPUT_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "tmp")
 OUTPUT_FILENAME_BASE = "-userdata.xml"
+GROUP_CHANGE_FILENAME_BASE = "-groupchanges.xml"
 GROUP_CHANGE_FILENAME = "group-changes.csv"
 NEW_DEPARTMENTS_FILENAME = "new-departments.csv"
-RETURN_ADDRESS = 'Patron Load <patronload@www.lib.pdx.edu>'
-SMTP_HOST = "mailhost.pdx.edu"
+REMOVED_BARCODES_FILENAME = "removed-barcodes.txt"
+MANIFEST_FILENAME = "userdata-manifest.csv"
+NOTICE_SUBJECT = 'Patron load notices'
+
+# Average number of records per chunk with a render cache. Small chunks are
+# more likely to be unchanged from one run to the next.
+CACHE_CHUNK_RECORDS = 1000
+
+PATRON_DATA_ENCODING = 'ISO-8859-1'
+PHONE_NON_DIGITS = re.compile(r'[^\d]+')
+# Banner doubles the closing quote of some values ending with a digit, e.g. "97201"",
+# which the csv module would read as a literal quote. Same matches as the former
+# sed expression s/\([0-9]"\)"/\1/g, but starting with the literal "" lets the regex
+# engine skip ahead instead of trying every character of the line.
+DOUBLED_QUOTE_AFTER_DIGIT = re.compile(r'""(?<=[0-9]"")')
+
+class ExpirationTable:
+    """
+    Expiration and purge dates of each patron type for a load run on a given day.
+    Dates are computed the first time a patron type is seen and reused afterwards.
+    """
+    current = None
+
+    def __init__(self, today=None):
+        self.today = today or date.today()
+        self.start_date = self.today.strftime("%Y%m%d")
+        self.dates = {}
+
+    @classmethod
+    def for_today(cls):
+        # Shared table, replaced when a long-running process crosses midnight
+        if cls.current is None or cls.current.today != date.today():
+            cls.current = cls()
+        return cls.current
+
+    def get(self, patron_type):
+        try:
+            return self.dates[patron_type]
+        except KeyError:
+            expdate = Patron.get_expiration_date(patron_type, self.today)
+            self.dates[patron_type] = (expdate, expdate + timedelta(days=180))
+            return self.dates[patron_type]
+
+
+class Patron(object):
+    __slots__ = ('first_name', 'barcode', 'middle_name', 'last_name', 'patron_type', 'coadmit_code',
+                 'address_line1', 'city', 'state', 'zip_code', 'address_type', 'expdate', 'purge_date',
+                 'email', 'email_address_type', 'telephone', 'telephone_type', 'telephone2',
+                 'telephone2_type', 'username', 'department_code', 'start_date')
+    # Attributes used by the user data template
+    template_fields = ('barcode', 'first_name', 'middle_name', 'last_name', 'patron_type', 'expdate',
+                       'purge_date', 'address_line1', 'city', 'state', 'zip_code', 'address_type', 'email',
+                       'email_address_type', 'telephone', 'telephone_type', 'telephone2', 'telephone2_type',
+                       'username', 'department_code')
 
-class Patron:
     campus_phone_prefix = '503-725-'
     campus_email_domain = 'pdx.edu'
     patron_types = {
@@ -64,38 +122,50 @@ class Patron:
     }
 
     @staticmethod
-    def get_expiration_date(patron_type):
+    def get_expiration_date(patron_type, today=None):
+        if today is None:
+            today = date.today()
+        year = today.year
+
         if patron_type in ['staff', 'staff-distance']:
-            if date.today() < datetime.strptime(str(date.today().year) + "0601", "%Y%m%d").date():
-                expdate = datetime.strptime(str(date.today().year + 2) + "0630", "%Y%m%d")
+            if today < date(year, 6, 1):
+                expdate = date(year + 2, 6, 30)
             else:
-                expdate = datetime.strptime(str(date.today().year + 1) + "0630", "%Y%m%d")
+                expdate = date(year + 1, 6, 30)
         elif patron_type in ['faculty', 'gradasst', 'emeritus', 'enrolled-faculty',
                              'faculty-distance', 'gradasst-distance', 'emeritus-distance']:
-            expdate = datetime.strptime(str(date.today().year + 2) + "0630", "%Y%m%d")
+            expdate = date(year + 2, 6, 30)
         elif patron_type in ['grad', 'undergrad', 'honors', 'highschool',
                              'grad-distance', 'undergrad-distance', 'highschool-distance']:
             # 1/1 - 3/14
-            if date.today() < datetime.strptime(str(date.today().year) + "0315", "%Y%m%d").date():
-                expdate = datetime.strptime(str(date.today().year) + "1020", "%Y%m%d")
+            if today < date(year, 3, 15):
+                expdate = date(year, 10, 20)
             # 3/15 - 6/14
-            elif date.today() < datetime.strptime(str(date.today().year) + "0615", "%Y%m%d").date():
-                expdate = datetime.strptime(str(date.today().year) + "1020", "%Y%m%d")
+            elif today < date(year, 6, 15):
+                expdate = date(year, 10, 20)
             # 6/15 - 8/31
-            elif date.today() < datetime.strptime(str(date.today().year) + "0901", "%Y%m%d").date():
-                expdate = datetime.strptime(str(date.today().year + 1) + "0131", "%Y%m%d")
+            elif today < date(year, 9, 1):
+                expdate = date(year + 1, 1, 31)
             # 9/1 - 12/14
-            elif date.today() < datetime.strptime(str(date.today().year) + "1215", "%Y%m%d").date():
-                expdate = datetime.strptime(str(date.today().year + 1) + "0425", "%Y%m%d")
+            elif today < date(year, 12, 15):
+                expdate = date(year + 1, 4, 25)
             # 12/15 - 12/31
             else:
-                expdate = datetime.strptime(str(date.today().year + 1) + "1020", "%Y%m%d")
+                expdate = date(year + 1, 10, 20)
         else:
-            expdate = datetime.strptime(str(date.today().year + 2) + "0630", "%Y%m%d")
+            expdate = date(year + 2, 6, 30)
 
-        return expdate.date()
+        return expdate
 
-    def __init__(self, patron_data, is_distance=False):
+    @classmethod
+    def get_patron_type(cls, banner_patron_type, is_distance=False):
+        """Return the Alma user group of a Banner patron type."""
+        if is_distance and banner_patron_type != 'HIGHSCHOOL':
+            return cls.patron_types[banner_patron_type] + "-distance"
+        else:
+            return cls.patron_types[banner_patron_type]
+
+    def __init__(self, patron_data, is_distance=False, expiration_table=None):
         """
         Patron Data Fields
         patron
@@ -134,15 +204,14 @@ class Patron:
         self.middle_name = patron_data['middle_name']
         self.last_name = patron_data['last_name']
 
-        if is_distance and patron_data['patron'] != 'HIGHSCHOOL':
-            self.patron_type = self.patron_types[patron_data['patron']] + "-distance"
-        else:
-            self.patron_type = self.patron_types[patron_data['patron']]
+        self.patron_type = self.get_patron_type(patron_data['patron'], is_distance)
 
         if patron_data['coadmit']:
             self.coadmit_code = self.coadmits[patron_data['coadmit']]
+        else:
+            self.coadmit_code = None
 
-        self.address_line1 = escape(patron_data['street_line1'])
+        self.address_line1 = patron_data['street_line1']
         self.city = patron_data['city_1']
         self.state = patron_data['state_1']
         self.zip_code = patron_data['zip_1'][:5]
@@ -154,8 +223,10 @@ class Patron:
         else:
             self.address_type = 'school'
 
-        self.expdate = self.get_expiration_date(self.patron_type)
-        self.purge_date = self.expdate + timedelta(days=180)
+        if expiration_table is None:
+            expiration_table = ExpirationTable.for_today()
+        self.expdate, self.purge_date = expiration_table.get(self.patron_type)
+        self.start_date = expiration_table.start_date
 
         self.email = patron_data['email']
         if self.email.endswith(self.campus_email_domain):
@@ -163,23 +234,13 @@ class Patron:
         else:
             self.email_address_type = 'personal'
 
-        # Sanitize phone numbers by stripping non-numeric characters and adding hyphens to the first 10 numbers
-        phone_numbers = re.compile(r'[^\d]+')
+        self.telephone = self.telephone_type = None
+        self.telephone2 = self.telephone2_type = None
         if patron_data['phone']:
-            clean_phone = phone_numbers.sub("", patron_data['phone'])
-            self.telephone = '-'.join([clean_phone[:3], clean_phone[3:6], clean_phone[6:10]])
-            if self.campus_phone_prefix in self.telephone:
-                self.telephone_type = 'office'
-            else:
-                self.telephone_type = 'home'
+            self.telephone, self.telephone_type = self.normalize_phone(patron_data['phone'])
         if patron_data['alt_phone']:
             if patron_data['alt_phone'] != patron_data['phone']:
-                clean_phone = phone_numbers.sub("", patron_data['alt_phone'])
-                self.telephone2 = '-'.join([clean_phone[:3], clean_phone[3:6], clean_phone[6:10]])
-                if self.campus_phone_prefix in self.telephone2:
-                    self.telephone2_type = 'office'
-                else:
-                    self.telephone2_type = 'home'
+                self.telephone2, self.telephone2_type = self.normalize_phone(patron_data['alt_phone'])
 
         if patron_data['stu_username'] == '':
             raise ValueError('Username missing for patron record %s' % self.barcode)
@@ -188,67 +249,169 @@ class Patron:
 
         if patron_data['orgn_desc']:
             self.department_code = patron_data['orgn_desc'].split(" ")[0]
+        else:
+            self.department_code = None
+
+    @classmethod
+    def normalize_phone(cls, phone):
+        """Return a phone number with hyphens added to its first 10 digits, and its phone type."""
+        # Sanitize phone numbers by stripping non-numeric characters
+        clean_phone = PHONE_NON_DIGITS.sub("", phone)
+        telephone = '-'.join([clean_phone[:3], clean_phone[3:6], clean_phone[6:10]])
+        if cls.campus_phone_prefix in telephone:
+            return telephone, 'office'
+        else:
+            return telephone, 'home'
+
+    def content_hash(self):
+        """Hash of the fields rendered in the user data template, used to detect changed records."""
+        values = []
+        for field in self.template_fields:
+            value = getattr(self, field)
+            values.append(u'' if value is None else u'%s' % value)
 
-        self.start_date = date.today().strftime("%Y%m%d")
+        return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).hexdigest()
 
 options = {
     u'-d, --debug': u'Debug mode',
+    u'-e, --engine': u'XML output engine: jinja (default) or direct',
+    u'--delta': u'Only write records added or changed since the given previous patron data file or snapshot',
+    u'--delta-date': u'Load date (YYYY-MM-DD) of the previous patron data file, when not in its name',
     u'-h, --help': u'Display help',
+    u'-m, --max-bytes': u'Split XML files larger than the given number of bytes',
+    u'--metrics': u'Write the run report as Prometheus metrics to the given file',
     u'-r, --recipients': u'Comma-separated list of email notice ecipient(s)',
+    u'--render-cache': u'Reuse the XML of unchanged chunks of records from the given cache file',
+    u'--report': u'Write the stage timings and rejected rows of the run as JSON to the given file',
+    u'-p, --snapshot': u'Update the given snapshot file with the records processed',
+    u'-s, --stream': u'Stream records from the patron data file into the XML files',
+    u'-w, --workers': u'Number of processes rendering XML files (default: 1)',
+    u'-z, --zip': u'Write the XML files compressed into the given ZIP file instead of the output folder',
 }
 
 
 def usage():
     print(u'\nUsage: patronload.py [options]\n')
     print(u'Options:')
-    for key, value in sorted(options.iteritems()):
+    for key, value in sorted(options.items()):
         print(u'\t%s\t%s' % (key, value))
     print(u'\n')
 
 
-def load_department_codes_file(file_path):
-    file_contents = {}
-
-    csv_file = open(file_path)
-    csv_reader = csv.DictReader(csv_file, delimiter=',')
-    for row in csv_reader:
-        file_contents[row['code']] = row['label']
-    csv_file.close()
+def repair_patron_data_lines(lines, report=None):
+    """
+    Yield the lines of the patron data file with the known Banner quoting defects
+    fixed, counting the lines repaired as repaired_rows in report.
+    """
+    repaired = 0
 
-    return file_contents
-
-
-def load_zip_codes_file(file_path):
-    file_contents = []
-
-    text_file = open(file_path)
-    file_contents = text_file.read().splitlines()
-    text_file.close()
-
-    return file_contents
-
-
-def load_patron_data_file(file_path, non_distance_zip_codes):
-    patron_data = {}
-
-    csv_file = open(file_path, 'rb')
-    csv_reader = unicodecsv.DictReader(csv_file, delimiter=',', encoding='ISO-8859-1') 
-    for row in csv_reader:
-        distance = False
-    
-        if row['zip_1'] and row['zip_1'][:5] not in non_distance_zip_codes:
-            distance = True
+    try:
+        for line in lines:
+            line, count = DOUBLED_QUOTE_AFTER_DIGIT.subn('"', line)
+            if count:
+                repaired += 1
+            yield line
+    finally:
+        if repaired:
+            logging.info("%s rows of the patron data file repaired." % repaired)
+        if report is not None:
+            report.count('repaired_rows', repaired)
+
+
+def iter_patron_data_rows(file_path, report=None):
+    """Yield each row of the patron data file as a dict of field names to values."""
+    with io.open(file_path, encoding=PATRON_DATA_ENCODING, newline='') as csv_file:
+        for row in csv.DictReader(repair_patron_data_lines(csv_file, report), delimiter=','):
+            yield row
+
+
+def is_distance_zip_code(zip_code, non_distance_zip_codes):
+    return bool(zip_code) and zip_code[:5] not in non_distance_zip_codes
+
+
+def iter_patrons(rows, non_distance_zip_codes, report=None, expiration_table=None):
+    """
+    Yield a Patron for every usable row, counting rejected rows by reason in report.
+    Expiration dates are those of a load run today, or of expiration_table.
+    """
+    if expiration_table is None:
+        expiration_table = ExpirationTable()
+
+    for row in rows:
+        distance = is_distance_zip_code(row['zip_1'], non_distance_zip_codes)
         try:
             if row['street_line1'] == '':
-                logging.warn("Mandatory field street_line1 is not present in record %s" % row['id_number'])
+                logging.warning("Mandatory field street_line1 is not present in record %s" % row['id_number'])
+                reason = 'missing_street'
             elif row['email'] == '':
-                logging.warn("Mandatory field email is not present in record %s" % row['id_number'])
+                logging.warning("Mandatory field email is not present in record %s" % row['id_number'])
+                reason = 'missing_email'
             else:
-                patron_data[row['id_number']] = Patron(row, distance)
+                yield Patron(row, distance, expiration_table)
+                continue
         except ValueError as error:
-            logging.warn(error.args)
+            logging.warning(error.args)
+            if row['stu_username'] == '':
+                reason = 'missing_username'
+            else:
+                reason = 'invalid_record'
+
+        if report is not None:
+            report.reject(reason)
+
+
+def iter_patron_data_file(file_path, non_distance_zip_codes, report=None, expiration_table=None):
+    """
+    Yield a Patron for every usable row of the patron data file as it is read,
+    so that callers never need to hold the whole export in memory. With a
+    RunReport, CSV parsing and Patron construction are timed as the parse and
+    patrons stages, and the rows repaired while reading are counted.
+    """
+    if report is None:
+        return iter_patrons(iter_patron_data_rows(file_path), non_distance_zip_codes,
+                            expiration_table=expiration_table)
+
+    rows = report.timed('parse', iter_patron_data_rows(file_path, report))
+    return report.timed('patrons', iter_patrons(rows, non_distance_zip_codes, report, expiration_table))
+
+
+def load_patron_groups(file_path, non_distance_zip_codes, barcodes=None):
+    """
+    Return the Alma user group of the patrons in the patron data file, keyed by
+    barcode, reading the file once. Only the barcodes given are kept when barcodes
+    is not None. Rows without a valid ZIP code or with an unknown patron type
+    are skipped.
+    """
+    patron_groups = {}
+
+    for row in iter_patron_data_rows(file_path):
+        barcode = row['id_number']
+        if barcodes is not None and barcode not in barcodes:
+            continue
+        if barcode in patron_groups:
+            # The first record of a barcode is kept, as by the patron load
+            continue
+        if not re.match(r'^\d{5}', row['zip_1']):
+            logging.info("No valid ZIP code in record %s" % barcode)
+            continue
+        try:
+            patron_groups[barcode] = Patron.get_patron_type(
+                row['patron'], is_distance_zip_code(row['zip_1'], non_distance_zip_codes))
+        except KeyError:
+            logging.warning("Unknown patron type %s in record %s" % (row['patron'], barcode))
+
+    return patron_groups
+
+
+def load_patron_data_file(file_path, non_distance_zip_codes, report=None):
+    """
+    Return the patrons of the patron data file keyed by barcode. As in stream
+    mode, the first record of a barcode is kept (see unique_patrons).
+    """
+    patron_data = {}
 
-    csv_file.close()
+    for patron in unique_patrons(iter_patron_data_file(file_path, non_distance_zip_codes, report), set()):
+        patron_data[patron.barcode] = patron
 
     return patron_data
 
@@ -258,14 +421,14 @@ def find_patron_data_diffs(patron_data, previous_file, non_distance_zip_codes):
     previous_patron_data = load_patron_data_file(previous_file, non_distance_zip_codes)
 
     for barcode, patron in patron_data.items():
-        if hasattr(patron, 'department_code'):
-            if barcode in previous_patron_data.keys():
-                if hasattr(previous_patron_data[barcode], 'department_code'):
+        if patron.department_code is not None:
+            if barcode in previous_patron_data:
+                if previous_patron_data[barcode].department_code is not None:
                     logging.debug("User with barcode %s changed from %s to %s." % (barcode, patron.department_code, previous_patron_data[barcode].department_code))
                     if patron.department_code != previous_patron_data[barcode].department_code:
                         group_changes[barcode] = patron.department_code 
                 else:
-                    logging.debug("Record for user with barcode %s has no department. Not updating this account." % (barcode, patron.department_code))
+                    logging.debug("Record for user with barcode %s had no department. Not updating this account to %s." % (barcode, patron.department_code))
             else:
                 logging.debug("User with barcode %s is was added today. Department code should be correct." % barcode)
 
@@ -274,18 +437,15 @@ def find_patron_data_diffs(patron_data, previous_file, non_distance_zip_codes):
 
 def find_new_department_codes(department_codes, patron_data):
     new_department_codes = []
+    seen_department_codes = set()
 
     for barcode, patron in patron_data.items():
-        if hasattr(patron, 'department_code'):
-            if patron.department_code not in department_codes and patron.department_code not in new_department_codes:
-                if hasattr(patron, 'department_name'):
-                    logging.debug("New department code %s \"%s\" found in record %s" % (patron.department_code,
-                                                                                        patron.department_name,
-                                                                                        patron.barcode))
-                else:
-                    logging.debug("New department code %s found in record %s" % (patron.department_code,
-                                                                                 patron.barcode))
+        if patron.department_code is not None:
+            if patron.department_code not in department_codes and patron.department_code not in seen_department_codes:
+                logging.debug("New department code %s found in record %s" % (patron.department_code,
+                                                                             patron.barcode))
                 new_department_codes.append(patron.department_code)
+                seen_department_codes.add(patron.department_code)
 
     return new_department_codes
 
@@ -293,8 +453,433 @@ def find_new_department_codes(department_codes, patron_data):
 def dict_chunks(dict_data, chunk_size=10000):
     # based on http://stackoverflow.com/questions/22878743/how-to-split-dictionary-into-multiple-dictionaries-fast
     iterator = iter(dict_data)
-    for i in xrange(0, len(dict_data), chunk_size):
-        yield {key: dict_data[key] for key in islice(iterator, chunk_size)}
+    for i in range(0, len(dict_data), chunk_size):
+        yield OrderedDict((key, dict_data[key]) for key in islice(iterator, chunk_size))
+
+
+def unique_patrons(patrons, seen_barcodes):
+    """
+    Yield the patrons of a stream whose barcode is not in seen_barcodes, adding
+    each barcode to it. Only the barcodes are kept; a barcode that appears again
+    is logged and skipped, so the first record of a barcode is the one loaded,
+    whether the export is streamed or not.
+    """
+    for patron in patrons:
+        if patron.barcode in seen_barcodes:
+            logging.warning("Duplicate record for barcode %s skipped" % patron.barcode)
+            continue
+        seen_barcodes.add(patron.barcode)
+        yield patron
+
+
+def patron_chunks(patrons, chunk_size=10000):
+    """Group a stream of Patron objects into barcode-keyed dicts of at most chunk_size records."""
+    chunk = OrderedDict()
+
+    for patron in patrons:
+        chunk[patron.barcode] = patron
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = OrderedDict()
+
+    if chunk:
+        yield chunk
+
+
+def stable_patron_chunks(patrons, chunk_records=CACHE_CHUNK_RECORDS, chunk_size=10000):
+    """
+    Group Patron objects into barcode-keyed dicts whose members stay the same from
+    one run to the next: each barcode goes to the bucket picked by its CRC, and the
+    records of a bucket are sorted by barcode. The number of buckets is the power of
+    two giving buckets of about chunk_records records, so it only changes when the
+    number of records doubles or halves. Reads every record before yielding.
+    """
+    patrons = list(patrons)
+    bucket_count = 1
+    while bucket_count * chunk_records < len(patrons):
+        bucket_count *= 2
+
+    buckets = [[] for i in range(bucket_count)]
+    for patron in patrons:
+        buckets[zlib.crc32(patron.barcode.encode('utf-8')) % bucket_count].append(patron)
+
+    for bucket in buckets:
+        bucket.sort(key=lambda patron: patron.barcode)
+        for start in range(0, len(bucket), chunk_size):
+            yield OrderedDict((patron.barcode, patron) for patron in bucket[start:start + chunk_size])
+
+
+def check_patron_chunks(patron_list_iterator, department_codes, new_department_codes, fn_ln_issues):
+    """
+    Run the department code and first name - last name checks on each chunk as it
+    goes by, collecting the results in new_department_codes and fn_ln_issues, and
+    yield the patrons of the chunk.
+    """
+    reported_department_codes = set(new_department_codes)
+
+    for patron_list in patron_list_iterator:
+        for department_code in find_new_department_codes(department_codes, patron_list):
+            if department_code not in reported_department_codes:
+                new_department_codes.append(department_code)
+                reported_department_codes.add(department_code)
+        fn_ln_issues.extend(find_fn_ln_issue(patron_list))
+
+        for patron in patron_list.values():
+            yield patron
+
+
+def patron_data_file_date(file_path):
+    """Return the load date in the name of a patron data file, e.g. patrondata-20191001.csv, or None."""
+    match = PATRON_DATA_FILE_DATE.search(os.path.basename(file_path))
+    if match is None:
+        return None
+    try:
+        return date(*[int(group) for group in match.groups()])
+    except ValueError:
+        return None
+
+
+def load_patron_hashes(file_path, non_distance_zip_codes, load_date):
+    """
+    Return the content hash of each patron of a previous patron data file, keyed
+    by barcode, with the expiration dates of its own load on load_date: patrons
+    whose expiration dates changed since then are found changed.
+    """
+    patron_hashes = {}
+    patrons = iter_patron_data_file(file_path, non_distance_zip_codes, expiration_table=ExpirationTable(load_date))
+
+    for patron in unique_patrons(patrons, set()):
+        patron_hashes[patron.barcode] = patron.content_hash()
+
+    return patron_hashes
+
+
+def changed_patrons(patrons, previous_hashes):
+    """Yield the patrons that are new or whose rendered fields changed since the previous export."""
+    for patron in patrons:
+        if previous_hashes.get(patron.barcode) != patron.content_hash():
+            yield patron
+
+
+def write_removed_barcodes_file(file_path, barcodes):
+    with open(file_path, 'w') as text_file:
+        for barcode in sorted(barcodes):
+            text_file.write(barcode + '\n')
+
+
+# Template environment of each templates folder. Compiled templates are kept by
+# the environment and only recompiled when the template file changes, so that
+# a long-running process compiles the template once.
+template_environments = {}
+
+
+def load_template(templates_folder=TEMPLATES_FOLDER, template_filename=TEMPLATE_FILENAME):
+    # Imported when needed so that the scripts importing this module start quickly
+    from jinja2 import Environment, FileSystemLoader
+
+    if templates_folder not in template_environments:
+        # Every value output by the template is XML-escaped
+        template_environments[templates_folder] = Environment(loader=FileSystemLoader(templates_folder),
+                                                              trim_blocks=True, autoescape=True)
+    return template_environments[templates_folder].get_template(template_filename)
+
+
+class TemplateRecords:
+    """
+    Stand-in for the patron_data of the user data template that counts the
+    records the template has moved to, so that its output can be split by record.
+    """
+
+    def __init__(self, patron_data):
+        self.patron_data = patron_data
+        self.position = 0
+
+    def items(self):
+        for item in self.patron_data.items():
+            self.position += 1
+            yield item
+        self.position += 1
+
+
+def template_segments(template, patron_data):
+    """
+    Yield the output of the user data template in segments: the start of the
+    document, the XML of each record, then the end of the document. The template
+    is rendered as a stream; a segment ends when the template moves to the next
+    record of patron_data.
+    """
+    records = TemplateRecords(patron_data)
+    position = 0
+    parts = []
+
+    for piece in template.generate(patron_data=records):
+        while position < records.position:
+            yield u''.join(parts)
+            parts = []
+            position += 1
+        parts.append(piece)
+
+    while position < records.position:
+        yield u''.join(parts)
+        parts = []
+        position += 1
+    yield u''.join(parts)
+
+
+class UserXMLRenderer:
+    """
+    Alma user XML of patron records, as UTF-8 bytes: the start and end of a
+    document, and the XML of each record, rendered once so that the records of a
+    chunk can be spread over several files. The jinja engine renders the user
+    data template; the direct engine writes the same XML without a template.
+    """
+
+    def __init__(self, engine='jinja', templates_folder=TEMPLATES_FOLDER, template_filename=TEMPLATE_FILENAME):
+        if engine == 'direct':
+            import userxml
+            self.template = None
+            self.user_xml = userxml.user_xml
+            self.start = userxml.DOCUMENT_START.encode('utf-8')
+            self.end = userxml.DOCUMENT_END.encode('utf-8')
+        elif engine == 'jinja':
+            self.template = load_template(templates_folder, template_filename)
+            segments = list(template_segments(self.template, {}))
+            self.start = segments[0].encode('utf-8')
+            self.end = segments[-1].encode('utf-8')
+        else:
+            raise ValueError('Unknown output engine %s' % engine)
+
+    def records(self, patron_data):
+        """Yield the XML of each patron of a barcode-keyed dict, in order."""
+        if self.template is None:
+            for patron in patron_data.values():
+                yield self.user_xml(patron).encode('utf-8')
+            return
+
+        segments = template_segments(self.template, patron_data)
+        next(segments)
+        for segment, barcode in zip(segments, patron_data):
+            yield segment.encode('utf-8')
+
+    def document(self, patron_data):
+        """Return a whole document of the patrons of a barcode-keyed dict."""
+        return self.start + b''.join(self.records(patron_data)) + self.end
+
+
+def renderer_hash(engine='jinja', templates_folder=TEMPLATES_FOLDER, template_filename=TEMPLATE_FILENAME,
+                  max_bytes=None):
+    """Hash of the template or code rendering the XML, and of the options changing its output."""
+    if engine == 'direct':
+        source_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'userxml.py')
+    else:
+        source_path = os.path.join(templates_folder, template_filename)
+
+    digest = hashlib.sha1(('%s\x1f%s\x1f' % (engine, max_bytes)).encode('utf-8'))
+    with open(source_path, 'rb') as source_file:
+        digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def chunk_key(renderer_digest, patron_data):
+    """Content address of a chunk: the hash of its records, in order, and of the renderer."""
+    digest = hashlib.sha1(renderer_digest.encode('utf-8'))
+    for barcode, patron in patron_data.items():
+        digest.update((u'\x1e%s\x1f%s' % (barcode, patron.content_hash())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Renderer used by the rendering processes of a PatronFileWriter pool
+worker_renderer = None
+
+
+def init_render_worker(engine, templates_folder, template_filename):
+    global worker_renderer
+    worker_renderer = UserXMLRenderer(engine, templates_folder, template_filename)
+
+
+def render_worker(patron_data):
+    return list(worker_renderer.records(patron_data))
+
+
+class PatronFileWriter:
+    """
+    Write chunks of patron records to numbered XML files of an OutputFolder or
+    OutputZip.
+
+    File numbers are assigned in the order chunks are handed to write(), so the
+    output is the same whatever the number of workers. Each record is rendered
+    once and written to the open file as it is rendered; a new file is started
+    when the next record would take the current one over max_bytes. With more
+    than one worker the records are rendered by a process pool; at most two
+    chunks per worker are queued at a time to keep memory bounded when the
+    chunks come from a stream. Rendering (or waiting for the pool) and writing
+    are timed as the render and write stages of report.
+
+    With a RenderCache, the documents of a chunk whose records and renderer are
+    unchanged are taken from the cache instead of being rendered, and the
+    documents rendered are added to it.
+    """
+
+    def __init__(self, output, workers=1, engine='jinja', max_bytes=None, report=None,
+                 templates_folder=TEMPLATES_FOLDER, template_filename=TEMPLATE_FILENAME, cache=None):
+        self.output = output
+        self.cache = cache
+        if cache is not None:
+            self.renderer_digest = renderer_hash(engine, templates_folder, template_filename, max_bytes)
+        self.report = report or RunReport('patronload', enabled=False)
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.file_iterator = 1
+        self.record_count = 0
+        self.pending = deque()
+        # Also used with a pool, for the start and end of the documents
+        self.renderer = UserXMLRenderer(engine, templates_folder, template_filename)
+
+        if workers > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(workers, init_render_worker,
+                                             (engine, templates_folder, template_filename))
+        else:
+            self.pool = None
+
+    def write(self, patron_data):
+        key = None
+        if self.cache is not None:
+            with self.report.stage('render_cache'):
+                key = chunk_key(self.renderer_digest, patron_data)
+                documents = self.cache.get(key)
+            if documents is not None:
+                logging.info("Reusing %s cached records." % len(patron_data))
+                self.report.count('render_cache_hits')
+                # Chunks queued before this one get the lower file numbers
+                while self.pending:
+                    self.collect()
+                self.written(documents)
+                return
+            self.report.count('render_cache_misses')
+
+        logging.info("Rendering %s records." % len(patron_data))
+
+        if self.pool is None:
+            self.write_records(self.report.timed('render', self.renderer.records(patron_data)), key)
+        else:
+            while len(self.pending) >= self.workers * 2:
+                self.collect()
+            self.pending.append((len(patron_data), key, self.pool.apply_async(render_worker, (patron_data,))))
+
+    def collect(self):
+        count, key, result = self.pending.popleft()
+        with self.report.stage('render', count):
+            records = result.get()
+        self.write_records(records, key)
+
+    def open_file(self):
+        filename = str(self.file_iterator) + OUTPUT_FILENAME_BASE
+        self.file_iterator += 1
+        # The record count of the manifest is set when the file is closed
+        output_file = self.output.open(filename, 0)
+        output_file.write(self.renderer.start)
+        return output_file
+
+    def close_file(self, output_file, count):
+        output_file.write(self.renderer.end)
+        output_file.record_count = count
+        output_file.close()
+        self.record_count += count
+        logging.info("%s records written to %s." % (count, output_file.filename))
+
+    def write_records(self, records, key=None):
+        """
+        Write the XML of the records of a chunk to new files, starting another file
+        when the next record would take the current one over max_bytes. A record
+        over the limit on its own is kept in a file of its own. With a cache key,
+        the documents written are added to the cache.
+        """
+        documents = [] if key is not None else None
+        output_file = None
+        count = size = 0
+
+        with self.report.stage('write'):
+            for record in records:
+                if output_file is not None and self.max_bytes is not None and \
+                        size + len(record) + len(self.renderer.end) > self.max_bytes:
+                    self.close_file(output_file, count)
+                    self.report.get_stage('write').rows += count
+                    output_file = None
+                if output_file is None:
+                    output_file = self.open_file()
+                    count = 0
+                    size = len(self.renderer.start)
+                    if documents is not None:
+                        documents.append([])
+                output_file.write(record)
+                if documents is not None:
+                    documents[-1].append(record)
+                count += 1
+                size += len(record)
+                if count == 1 and self.max_bytes is not None and \
+                        size + len(self.renderer.end) > self.max_bytes:
+                    logging.warning("Record alone in %s is larger than %s bytes." % (output_file.filename,
+                                                                                    self.max_bytes))
+
+            if output_file is not None:
+                self.close_file(output_file, count)
+                self.report.get_stage('write').rows += count
+
+        if documents is not None:
+            self.cached(key, [(len(parts), self.renderer.start + b''.join(parts) + self.renderer.end)
+                              for parts in documents])
+
+    def cached(self, key, documents):
+        with self.report.stage('render_cache'):
+            self.cache.put(key, documents)
+
+    def written(self, documents):
+        for count, document in documents:
+            filename = str(self.file_iterator) + OUTPUT_FILENAME_BASE
+            self.file_iterator += 1
+
+            with self.report.stage('write', count):
+                with self.output.open(filename, count) as output_file:
+                    output_file.write(document)
+            self.record_count += count
+            logging.info("%s records written to %s." % (count, filename))
+
+    def close(self):
+        if self.pool is not None:
+            try:
+                while self.pending:
+                    self.collect()
+                self.pool.close()
+            except:
+                self.pool.terminate()
+                raise
+            finally:
+                self.pool.join()
+
+        with self.report.stage('write'):
+            self.output.close()
+        return self.record_count
+
+
+def write_group_change_files(group_changes, output, chunk_size=10000):
+    """
+    Write a barcode-keyed dict of group names as numbered partial user XML files of
+    at most chunk_size records, the way main() writes the patron records, so that
+    the SIS import changes the groups. Returns the number of records written.
+    """
+    from userxml import write_group_changes
+
+    record_count = 0
+    for file_number, chunk in enumerate(dict_chunks(group_changes, chunk_size), 1):
+        filename = str(file_number) + GROUP_CHANGE_FILENAME_BASE
+        with output.open(filename, len(chunk)) as output_file:
+            write_group_changes(chunk, output_file)
+        record_count += len(chunk)
+        logging.info("%s group changes written to %s." % (len(chunk), filename))
+
+    output.close()
+    return record_count
 
 
 def find_fn_ln_issue(patron_data):
@@ -307,9 +892,12 @@ def find_fn_ln_issue(patron_data):
     return issues
 
 
-def main():
+def main(argv):
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'dhr:', ['help', 'debug', 'recipients'])
+        opts, args = getopt.gnu_getopt(argv[1:], 'de:hm:p:r:sw:z:', ['help', 'debug', 'delta=', 'delta-date=',
+                                                                          'engine=', 'max-bytes=', 'metrics=',
+                                                                          'recipients=', 'render-cache=', 'report=',
+                                                                          'snapshot=', 'stream', 'workers=', 'zip='])
     except getopt.GetoptError as error:
         print(str(error))
         usage()
@@ -317,6 +905,17 @@ def main():
 
     option_missing = False
     debug = False
+    stream = False
+    workers = 1
+    engine = 'jinja'
+    max_bytes = None
+    zip_file = None
+    previous_file = None
+    previous_date = None
+    snapshot_file = None
+    report_file = None
+    metrics_file = None
+    render_cache_file = None
     notice_recipients = []
 
     for opt, arg in opts:
@@ -325,8 +924,49 @@ def main():
             sys.exit(2)
         if opt in ('-d', '--debug'):
             debug = True
+        if opt == '--delta':
+            previous_file = arg
+        if opt == '--delta-date':
+            try:
+                previous_date = date(*[int(part) for part in arg.split('-')])
+            except (TypeError, ValueError):
+                print('Load date of the previous patron data file must be YYYY-MM-DD')
+                option_missing = True
+        if opt in ('-e', '--engine'):
+            engine = arg
+            if engine not in ('jinja', 'direct'):
+                print('Unknown output engine %s' % engine)
+                option_missing = True
+        if opt in ('-m', '--max-bytes'):
+            try:
+                max_bytes = int(arg)
+            except ValueError:
+                max_bytes = 0
+            if max_bytes < 1:
+                print('Maximum number of bytes must be a positive integer')
+                option_missing = True
+        if opt == '--metrics':
+            metrics_file = arg
+        if opt == '--render-cache':
+            render_cache_file = arg
+        if opt == '--report':
+            report_file = arg
         if opt in ('-r', '--recipients'):
             notice_recipients = arg.split(',')
+        if opt in ('-p', '--snapshot'):
+            snapshot_file = arg
+        if opt in ('-s', '--stream'):
+            stream = True
+        if opt in ('-w', '--workers'):
+            try:
+                workers = int(arg)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print('Number of workers must be a positive integer')
+                option_missing = True
+        if opt in ('-z', '--zip'):
+            zip_file = arg
 
     if len(notice_recipients) == 0:
         print('Email notice recipients missing')
@@ -341,49 +981,125 @@ def main():
     else:
         logging.basicConfig(level=logging.WARN)
 
-    department_codes = load_department_codes_file(DEPARTMENTS_FILE)
-    non_distance_zip_codes = sorted(load_zip_codes_file(ZIP_CODES_FILE))
-    patron_data = load_patron_data_file(CURRENT_PATRON_DATA_FILE, non_distance_zip_codes)
-    new_department_codes = find_new_department_codes(department_codes, patron_data)
-    fn_ln_issues = find_fn_ln_issue(patron_data)
-
-    if len(new_department_codes) > 0:
-        message_text = "New department codes were found in the patron load\n\n"
-        for department_code in new_department_codes:
-            message_text += "\n" + str(department_code)
+    from patronstore import PatronStore
 
-        message = MIMEText(message_text)
-        message['Subject'] = 'New department codes found in the patron load'
-        message['From'] = RETURN_ADDRESS
-        message['To'] = ', '.join(notice_recipients)
+    report = RunReport('patronload', enabled=report_file is not None or metrics_file is not None)
 
-        s = smtplib.SMTP(SMTP_HOST)
-        s.sendmail(re.findall(r'<(.*)>', RETURN_ADDRESS)[0], notice_recipients, message.as_string())
-        s.quit()
+    with report.stage('reference_data'):
+        department_codes = load_reference_file(load_department_codes_file, DEPARTMENTS_FILE)
+        non_distance_zip_codes = load_reference_file(load_zip_codes_file, ZIP_CODES_FILE)
 
-    if len(fn_ln_issues) > 0:
-        for barcode in fn_ln_issues:
-            logging.warn("First name - last name issue with %s" % barcode)
-
-    env = Environment(loader=FileSystemLoader(TEMPLATES_FOLDER), trim_blocks=True)
-    template = env.get_template(TEMPLATE_FILENAME)
-    file_iterator = 1
+    if previous_file is not None:
+        with report.stage('previous_data'):
+            if PatronStore.is_store(previous_file):
+                previous_store = PatronStore(previous_file)
+                previous_hashes = previous_store.get_hashes()
+                previous_store.close()
+            else:
+                # Hashed with the expiration dates of its own load, so that the
+                # patrons whose expiration dates roll over today are written
+                previous_date = previous_date or patron_data_file_date(previous_file)
+                if previous_date is None:
+                    print('Load date of %s unknown: give it with --delta-date' % previous_file)
+                    usage()
+                    sys.exit(2)
+                previous_hashes = load_patron_hashes(previous_file, non_distance_zip_codes, previous_date)
+    else:
+        previous_hashes = None
 
-    logging.info("%s records found." % len(patron_data))
+    if stream:
+        # Rows are turned into Patron objects and written out as they are read,
+        # so memory use is bounded by the chunk size rather than the export size.
+        patrons = iter_patron_data_file(CURRENT_PATRON_DATA_FILE, non_distance_zip_codes, report)
+    else:
+        patron_data = load_patron_data_file(CURRENT_PATRON_DATA_FILE, non_distance_zip_codes, report)
+        logging.info("%s records found." % len(patron_data))
+        patrons = patron_data.values()
 
-    for patron_list in dict_chunks(patron_data, 10000):
-        result = template.render(patron_data=patron_list)
-        filename = str(file_iterator) + OUTPUT_FILENAME_BASE
+    if zip_file is not None:
+        output = OutputZip(zip_file)
+    else:
+        output = OutputFolder(OUTPUT_FOLDER)
+    if render_cache_file is not None:
+        from rendercache import RenderCache
+        render_cache = RenderCache(render_cache_file)
+    else:
+        render_cache = None
+    writer = PatronFileWriter(output, workers, engine, max_bytes, report, cache=render_cache)
+    current_barcodes = set()
+    new_department_codes = []
+    fn_ln_issues = []
+
+    patrons = unique_patrons(patrons, current_barcodes)
+    patrons = report.timed('checks', check_patron_chunks(patron_chunks(patrons, 10000), department_codes,
+                                                         new_department_codes, fn_ln_issues))
+    if snapshot_file is not None:
+        store = PatronStore(snapshot_file)
+        patrons = report.timed('snapshot', store.track(patrons))
+    if previous_hashes is not None:
+        patrons = report.timed('delta', changed_patrons(patrons, previous_hashes))
+
+    if render_cache is not None:
+        # Chunks keep the same records from run to run, so that unchanged chunks
+        # are found in the cache. The records are all read before any is written.
+        patron_lists = stable_patron_chunks(patrons)
+    else:
+        patron_lists = patron_chunks(patrons, 10000)
+    for patron_list in patron_lists:
+        writer.write(patron_list)
+
+    record_count = writer.close()
+
+    # Every row has been read: the digest is sent while the run finishes
+    from notify import Digest, Notifier
+    digest = Digest(NOTICE_SUBJECT)
+    digest.add('New department codes found in the patron load', new_department_codes)
+    digest.add('Rejected rows', ('%s: %s' % (reason, count) for reason, count in report.rejects.items()))
+    digest.add('First name - last name issues', fn_ln_issues)
+    if len(digest) > 0:
+        notifier = Notifier()
+        notifier.send(digest.message(notice_recipients))
+    else:
+        notifier = None
+
+    if render_cache is not None:
+        logging.info("Render cache: %s of %s chunks reused (%.0f%%)." % (
+            render_cache.hits, render_cache.hits + render_cache.misses, render_cache.hit_rate() * 100))
+        with report.stage('render_cache'):
+            render_cache.prune()
+            render_cache.close()
+
+    logging.info("%s records written." % record_count)
+    write_manifest(os.path.join(OUTPUT_FOLDER, MANIFEST_FILENAME), output.manifest)
+    report.count('records_read', len(current_barcodes))
+    report.count('records_written', record_count)
+    report.count('files_written', len(output.manifest))
+
+    if snapshot_file is not None:
+        with report.stage('snapshot'):
+            store.finish()
+            store.close()
+
+    if previous_hashes is not None:
+        removed_barcodes = set(previous_hashes) - current_barcodes
+        logging.info("%s records changed or added, %s removed since %s." % (record_count,
+                                                                          len(removed_barcodes),
+                                                                          previous_file))
+        write_removed_barcodes_file(os.path.join(OUTPUT_FOLDER, REMOVED_BARCODES_FILENAME),
+                                    removed_barcodes)
+        report.count('records_removed', len(removed_barcodes))
+
+    report.count('new_department_codes', len(new_department_codes))
+    report.count('name_issues', len(fn_ln_issues))
+    report.write(report_file, metrics_file)
 
-        logging.info("Writing %s records to %s." % (len(patron_list), filename))
+    if len(fn_ln_issues) > 0:
+        for barcode in fn_ln_issues:
+            logging.warning("First name - last name issue with %s" % barcode)
 
-        with codecs.open(os.path.join(OUTPUT_FOLDER, filename), 'w', encoding="utf-8") as f:
-            f.write(result)
-            f.close()
-        file_iterator += 1
-        logging.info("Data written to " + filename + ".")
+    if notifier is not None:
+        notifier.close()
 
 
 if __name__ == '__main__':
-    main()
-
+    main(sys.argv)
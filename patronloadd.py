@@ -0,0 +1,413 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Resident job server for the patron load scripts. The server loads the
+# scripts once and runs their jobs one at a time in the same process, so the
+# compiled template, the reference data files and the HTTP sessions to Alma
+# stay warm from one job to the next instead of being set up by a new
+# interpreter for every run.
+#
+# Clients talk to the server over a Unix socket, one JSON object per line.
+# The 'run' command submits a job, waits for it and prints its output, so it
+# can stand in for running the script with the interpreter:
+#
+#   venv/bin/python patronloadd.py serve &
+#   venv/bin/python patronloadd.py run change-patron-group.py -g GROUP BARCODE
+#   venv/bin/python patronloadd.py -i run change-patron-group.py -f - < barcodes.txt
+#   venv/bin/python patronloadd.py jobs
+#
+
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+from collections import OrderedDict, deque
+from io import StringIO
+from optparse import OptionParser
+from queue import Queue
+
+from instrumentation import cpu_time, peak_rss
+
+
+APP_FOLDER = os.path.dirname(os.path.realpath(__file__))
+# Kept out of tmp/, which clean-up.sh empties after every nightly run
+RUN_FOLDER = os.path.join(APP_FOLDER, "run")
+SOCKET_FILE = os.path.join(RUN_FOLDER, "patronloadd.sock")
+JOBS_FOLDER = os.path.join(RUN_FOLDER, "patronloadd-jobs")
+
+# Scripts that can be run as jobs
+JOB_SCRIPTS = ['patronload.py', 'change-patron-group.py', 'fetch-analytics-report-data.py',
+               'find-unexpirations.py', 'notify.py']
+# Number of finished jobs kept, with their output files
+JOB_HISTORY = 100
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+
+logger = logging.getLogger('patronloadd')
+
+
+def load_job_scripts(scripts=JOB_SCRIPTS):
+    modules = {}
+    for script in scripts:
+        name = os.path.splitext(script)[0].replace('-', '_')
+        spec = importlib.util.spec_from_file_location(name, os.path.join(APP_FOLDER, script))
+        modules[script] = importlib.util.module_from_spec(spec)
+        # Registered first, so that the other scripts importing it share this module
+        sys.modules[name] = modules[script]
+        spec.loader.exec_module(modules[script])
+    return modules
+
+
+def reset_logging():
+    """Remove the handlers of the root logger, so that the next job's basicConfig applies."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(logging.WARN)
+
+
+class Job:
+    def __init__(self, job_id, script, args, cwd, stdin=''):
+        self.job_id = job_id
+        self.script = script
+        self.args = args
+        self.cwd = cwd
+        self.stdin = stdin
+        self.state = QUEUED
+        self.exit_code = None
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.cpu_time = self.children_cpu_time = None
+        self.server_peak_rss = None
+        self.stdout = os.path.join(JOBS_FOLDER, '%s.out' % job_id)
+        self.stderr = os.path.join(JOBS_FOLDER, '%s.err' % job_id)
+
+    def as_dict(self):
+        job = OrderedDict([
+            ('id', self.job_id),
+            ('script', self.script),
+            ('args', self.args),
+            ('cwd', self.cwd),
+            ('state', self.state),
+            ('exit_code', self.exit_code),
+            ('submitted', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.submitted))),
+            ('queued_seconds', None),
+            ('run_seconds', None),
+            ('cpu_seconds', self.cpu_time),
+            ('children_cpu_seconds', self.children_cpu_time),
+            # Peak RSS of the server so far, since a process can't measure it for one job
+            ('server_peak_rss_bytes', self.server_peak_rss),
+            ('stdout', self.stdout),
+            ('stderr', self.stderr),
+        ])
+        if self.started is not None:
+            job['queued_seconds'] = round(self.started - self.submitted, 6)
+        if self.finished is not None:
+            job['run_seconds'] = round(self.finished - self.started, 6)
+        return job
+
+    def run(self, module):
+        """Run the script's main() as if the script was started with the job's arguments."""
+        saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+        start_times = os.times()
+        self.started = time.time()
+        self.state = RUNNING
+
+        with open(self.stdout, 'w', encoding='utf-8') as stdout, \
+                open(self.stderr, 'w', encoding='utf-8') as stderr:
+            sys.argv = [self.script] + self.args
+            sys.stdin = StringIO(self.stdin)
+            sys.stdout = stdout
+            sys.stderr = stderr
+            reset_logging()
+            try:
+                os.chdir(self.cwd)
+                if hasattr(module, 'current_patron_data_file'):
+                    # The day's patron data file changes while the server runs
+                    module.CURRENT_PATRON_DATA_FILE = module.current_patron_data_file()
+                module.main(sys.argv)
+                self.exit_code = 0
+            except SystemExit as exit:
+                if exit.code is None:
+                    self.exit_code = 0
+                elif isinstance(exit.code, int):
+                    self.exit_code = exit.code
+                else:
+                    stderr.write('%s\n' % exit.code)
+                    self.exit_code = 1
+            except Exception:
+                traceback.print_exc(file=stderr)
+                self.exit_code = 1
+            finally:
+                reset_logging()
+                sys.argv, sys.stdin, sys.stdout, sys.stderr, cwd = saved
+                os.chdir(cwd)
+
+        end_times = os.times()
+        self.finished = time.time()
+        self.cpu_time = round(cpu_time(end_times) - cpu_time(start_times), 6)
+        self.children_cpu_time = round(sum(end_times[2:4]) - sum(start_times[2:4]), 6)
+        self.server_peak_rss = peak_rss()
+        self.state = FINISHED
+
+
+class JobRunner:
+    """Queue of jobs, run one at a time by a worker thread."""
+
+    def __init__(self, modules):
+        self.modules = modules
+        self.queue = Queue()
+        self.jobs = OrderedDict()
+        self.finished = deque()
+        self.condition = threading.Condition()
+        self.next_id = 1
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, script, args, cwd, stdin=''):
+        if script not in self.modules:
+            raise ValueError("Unknown script %s." % script)
+
+        with self.condition:
+            job = Job(self.next_id, script, args, cwd, stdin)
+            self.next_id += 1
+            self.jobs[job.job_id] = job
+        logger.info("Job %s queued: %s %s" % (job.job_id, script, ' '.join(args)))
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            if job_id not in self.jobs:
+                raise ValueError("Unknown job %s." % job_id)
+            return self.jobs[job_id]
+
+    def wait(self, job_id):
+        job = self.get(job_id)
+        with self.condition:
+            while job.state != FINISHED:
+                self.condition.wait(1)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            logger.info("Job %s started." % job.job_id)
+            job.run(self.modules[job.script])
+            logger.info("Job %s finished with exit code %s in %.3f seconds." %
+                        (job.job_id, job.exit_code, job.finished - job.started))
+
+            with self.condition:
+                self.finished.append(job)
+                while len(self.finished) > JOB_HISTORY:
+                    self.forget(self.finished.popleft())
+                self.condition.notify_all()
+
+    def forget(self, job):
+        del self.jobs[job.job_id]
+        for file_path in (job.stdout, job.stderr):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def stop(self):
+        """Stop once the jobs already queued have run."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = {'ok': True}
+            response.update(self.server.execute(request))
+        except Exception as error:
+            response = {'ok': False, 'error': str(error)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+        if self.server.shutdown_requested:
+            # Only once the reply is sent, since the process exits when the server stops.
+            # shutdown() waits for serve_forever() to return, so it can't run in this thread.
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class JobServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, runner):
+        socketserver.ThreadingUnixStreamServer.__init__(self, socket_file, RequestHandler)
+        self.runner = runner
+        self.shutdown_requested = False
+
+    def execute(self, request):
+        command = request.get('command')
+
+        if command == 'ping':
+            return {}
+        elif command == 'submit':
+            job = self.runner.submit(request['script'], request.get('args', []), request['cwd'],
+                                     request.get('stdin', ''))
+            return {'job': job.as_dict()}
+        elif command == 'status':
+            return {'job': self.runner.get(request['id']).as_dict()}
+        elif command == 'wait':
+            return {'job': self.runner.wait(request['id']).as_dict()}
+        elif command == 'jobs':
+            with self.runner.condition:
+                return {'jobs': [job.as_dict() for job in self.runner.jobs.values()]}
+        elif command == 'shutdown':
+            self.shutdown_requested = True
+            return {}
+        else:
+            raise ValueError("Unknown command %s." % command)
+
+
+def send_request(socket_file, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        line = client.makefile('rb').readline()
+    finally:
+        client.close()
+
+    if not line:
+        raise ConnectionError("The server closed the connection without replying.")
+    response = json.loads(line, object_pairs_hook=OrderedDict)
+
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response
+
+
+def serve(socket_file):
+    if os.path.exists(socket_file):
+        try:
+            send_request(socket_file, {'command': 'ping'})
+            sys.stderr.write("A server is already listening on %s.\n" % socket_file)
+            sys.exit(1)
+        except socket.error:
+            os.remove(socket_file)
+
+    if not os.path.isdir(JOBS_FOLDER):
+        os.makedirs(JOBS_FOLDER)
+
+    # Imported here rather than at the top so that the client starts quickly
+    import almaapi
+
+    logger.info("Loading the job scripts...")
+    almaapi.keep_sessions()
+    runner = JobRunner(load_job_scripts())
+
+    old_umask = os.umask(0o077)
+    try:
+        server = JobServer(socket_file, runner)
+    finally:
+        os.umask(old_umask)
+
+    logger.info("Listening on %s." % socket_file)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        runner.stop()
+        # Removed last, so that the socket file is gone only once the queued jobs have run
+        os.remove(socket_file)
+        logger.info("Stopped.")
+
+
+def print_jobs(jobs):
+    print('id\tstate\texit_code\tqueued_seconds\trun_seconds\tcpu_seconds\tscript')
+    for job in jobs:
+        print('\t'.join('' if job[key] is None else '%s' % job[key]
+                        for key in ['id', 'state', 'exit_code', 'queued_seconds', 'run_seconds',
+                                    'cpu_seconds', 'script']))
+
+
+def copy_file(file_path, output_file):
+    with open(file_path, 'rb') as input_file:
+        shutil.copyfileobj(input_file, output_file)
+    output_file.flush()
+
+
+def main(argv):
+    usage = "usage: %prog [options] serve | ping | run SCRIPT [ARG...] | submit SCRIPT [ARG...] | " \
+            "status JOB_ID | jobs | shutdown"
+
+    parser = OptionParser(usage=usage)
+    parser.disable_interspersed_args()
+    parser.add_option('-i', '--stdin',
+                      help='Send the standard input to the job',
+                      action='store_true',
+                      default=False,
+                      dest='stdin')
+    parser.add_option('-s', '--socket',
+                      help='Unix socket of the server (default: %s)' % SOCKET_FILE,
+                      default=SOCKET_FILE,
+                      dest='socket_file')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error('Command missing.')
+    command = args[0]
+
+    if command == 'serve':
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        # Jobs configure the root logger; the server's own messages stay apart
+        logger.propagate = False
+        serve(options.socket_file)
+        return
+
+    try:
+        if command == 'ping':
+            send_request(options.socket_file, {'command': 'ping'})
+        elif command in ('run', 'submit') and len(args) > 1:
+            stdin = sys.stdin.read() if options.stdin else ''
+            response = send_request(options.socket_file, {'command': 'submit', 'script': args[1],
+                                                          'args': args[2:], 'cwd': os.getcwd(),
+                                                          'stdin': stdin})
+            job = response['job']
+            if command == 'submit':
+                print(job['id'])
+                return
+
+            job = send_request(options.socket_file, {'command': 'wait', 'id': job['id']})['job']
+            copy_file(job['stdout'], sys.stdout.buffer)
+            copy_file(job['stderr'], sys.stderr.buffer)
+            sys.exit(job['exit_code'])
+        elif command == 'status' and len(args) == 2:
+            response = send_request(options.socket_file, {'command': 'status', 'id': int(args[1])})
+            print(json.dumps(response['job'], indent=2))
+        elif command == 'jobs':
+            print_jobs(send_request(options.socket_file, {'command': 'jobs'})['jobs'])
+        elif command == 'shutdown':
+            send_request(options.socket_file, {'command': 'shutdown'})
+        else:
+            parser.error('Unknown command.')
+    except (socket.error, RuntimeError) as error:
+        sys.stderr.write("%s\n" % error)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
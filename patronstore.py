@@ -0,0 +1,213 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Snapshot of the patrons processed by the patron load, kept in a local
+# SQLite database keyed by barcode. Each run stages the patrons it processed
+# and only rows that were added, changed or removed are written to the
+# snapshot when the run finishes.
+#
+
+import json
+import logging
+import sqlite3
+import sys
+
+from datetime import date, timedelta
+from optparse import OptionParser
+
+
+# Removed patrons are deleted from the snapshot after this many days
+RETENTION_DAYS = 90
+# Rebuild the database file when this share of its pages is unused
+COMPACTION_THRESHOLD = 0.25
+STAGING_BATCH_SIZE = 5000
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patrons (
+    barcode TEXT PRIMARY KEY,
+    username TEXT,
+    patron_type TEXT,
+    zip_code TEXT,
+    department_code TEXT,
+    fields TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    first_seen TEXT NOT NULL,
+    changed_on TEXT NOT NULL,
+    removed_on TEXT
+);
+CREATE INDEX IF NOT EXISTS patrons_changed_on ON patrons (changed_on);
+CREATE INDEX IF NOT EXISTS patrons_removed_on ON patrons (removed_on);
+"""
+
+
+class PatronStore:
+    """
+    Snapshot of normalized patron fields and content hashes.
+
+    Patrons passed through track() are staged in a temporary table; finish()
+    applies them to the snapshot in a single transaction, so a run that fails
+    part way through leaves the previous snapshot untouched.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path)
+        self.connection.executescript(SCHEMA)
+        self.staged = []
+        self.staging = False
+
+    @staticmethod
+    def is_store(file_path):
+        with open(file_path, 'rb') as store_file:
+            return store_file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+    def close(self):
+        self.connection.close()
+
+    def get_hashes(self):
+        """Return the content hash of every current patron, keyed by barcode."""
+        cursor = self.connection.execute("SELECT barcode, content_hash FROM patrons WHERE removed_on IS NULL")
+        return dict(cursor)
+
+    def lookup(self, barcode):
+        row = self.connection.execute(
+            "SELECT fields, content_hash, first_seen, changed_on, removed_on FROM patrons WHERE barcode = ?",
+            (barcode,)).fetchone()
+        if row is None:
+            return None
+
+        record = json.loads(row[0])
+        record.update(content_hash=row[1], first_seen=row[2], changed_on=row[3], removed_on=row[4])
+        return record
+
+    def changed_since(self, since):
+        """Return the barcodes of patrons added, changed or removed on or after the date since."""
+        cursor = self.connection.execute(
+            "SELECT barcode FROM patrons WHERE changed_on >= ? OR removed_on >= ? ORDER BY barcode",
+            (since.isoformat(), since.isoformat()))
+        return [row[0] for row in cursor]
+
+    def track(self, patrons):
+        """Stage each patron of a stream for the snapshot and yield it unchanged."""
+        if not self.staging:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS current ("
+                                    "barcode TEXT PRIMARY KEY, username TEXT, patron_type TEXT, "
+                                    "zip_code TEXT, department_code TEXT, fields TEXT, content_hash TEXT)")
+            self.connection.execute("DELETE FROM current")
+            self.staging = True
+
+        for patron in patrons:
+            fields = {}
+            for field in patron.template_fields:
+                value = getattr(patron, field)
+                fields[field] = None if value is None else u'%s' % value
+            self.staged.append((patron.barcode, patron.username, patron.patron_type, patron.zip_code,
+                                patron.department_code, json.dumps(fields, sort_keys=True),
+                                patron.content_hash()))
+            if len(self.staged) >= STAGING_BATCH_SIZE:
+                self.flush()
+
+            yield patron
+
+    def flush(self):
+        self.connection.executemany("INSERT OR REPLACE INTO current VALUES (?, ?, ?, ?, ?, ?, ?)", self.staged)
+        self.staged = []
+
+    def finish(self, run_date=None, retention_days=RETENTION_DAYS):
+        """
+        Apply the staged patrons to the snapshot: add new patrons, update changed
+        ones, mark missing ones as removed and delete those removed more than
+        retention_days ago. Returns a dict with the number of rows affected.
+        """
+        if not self.staging:
+            raise RuntimeError('No patrons were staged for the snapshot')
+
+        self.flush()
+        run_date = (run_date or date.today()).isoformat()
+        cutoff = (date.today() - timedelta(days=retention_days)).isoformat()
+        counts = {}
+
+        with self.connection:
+            counts['changed'] = self.connection.execute(
+                "UPDATE patrons SET "
+                "username = (SELECT username FROM current WHERE current.barcode = patrons.barcode), "
+                "patron_type = (SELECT patron_type FROM current WHERE current.barcode = patrons.barcode), "
+                "zip_code = (SELECT zip_code FROM current WHERE current.barcode = patrons.barcode), "
+                "department_code = (SELECT department_code FROM current WHERE current.barcode = patrons.barcode), "
+                "fields = (SELECT fields FROM current WHERE current.barcode = patrons.barcode), "
+                "content_hash = (SELECT content_hash FROM current WHERE current.barcode = patrons.barcode), "
+                "changed_on = ?, removed_on = NULL "
+                "WHERE barcode IN (SELECT current.barcode FROM current JOIN patrons AS previous "
+                "ON previous.barcode = current.barcode "
+                "WHERE previous.content_hash != current.content_hash OR previous.removed_on IS NOT NULL)",
+                (run_date,)).rowcount
+            counts['added'] = self.connection.execute(
+                "INSERT OR IGNORE INTO patrons "
+                "SELECT barcode, username, patron_type, zip_code, department_code, fields, content_hash, "
+                "?, ?, NULL FROM current", (run_date, run_date)).rowcount
+            counts['removed'] = self.connection.execute(
+                "UPDATE patrons SET removed_on = ? WHERE removed_on IS NULL "
+                "AND barcode NOT IN (SELECT barcode FROM current)", (run_date,)).rowcount
+            counts['deleted'] = self.connection.execute(
+                "DELETE FROM patrons WHERE removed_on < ?", (cutoff,)).rowcount
+            self.connection.execute("DELETE FROM current")
+
+        self.staging = False
+        logging.info("Snapshot %s: %s added, %s changed, %s removed, %s deleted." % (
+            self.file_path, counts['added'], counts['changed'], counts['removed'], counts['deleted']))
+
+        if counts['deleted'] > 0:
+            self.compact()
+
+        return counts
+
+    def compact(self, force=False):
+        """Rebuild the database file when enough of it is unused space."""
+        page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.connection.execute("PRAGMA freelist_count").fetchone()[0]
+
+        if force or (page_count and free_pages / float(page_count) >= COMPACTION_THRESHOLD):
+            logging.info("Compacting snapshot %s (%s of %s pages free)." % (self.file_path, free_pages,
+                                                                            page_count))
+            self.connection.execute("VACUUM")
+
+
+def main(argv):
+    usage = "usage: %prog [options] lookup BARCODE... | changes YYYY-MM-DD | compact"
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--file',
+                      help='Snapshot file',
+                      dest='file_path')
+
+    (options, args) = parser.parse_args()
+
+    if options.file_path is None or len(args) == 0:
+        parser.error('Snapshot file or command missing.')
+
+    store = PatronStore(options.file_path)
+    command = args[0]
+
+    try:
+        if command == 'lookup':
+            for barcode in args[1:]:
+                record = store.lookup(barcode)
+                if record is None:
+                    print('%s\tnot found' % barcode)
+                else:
+                    print('%s\t%s' % (barcode, json.dumps(record, sort_keys=True)))
+        elif command == 'changes' and len(args) == 2:
+            year, month, day = [int(part) for part in args[1].split('-')]
+            for barcode in store.changed_since(date(year, month, day)):
+                print(barcode)
+        elif command == 'compact':
+            store.compact(force=True)
+        else:
+            parser.error('Unknown command.')
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
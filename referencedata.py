@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Reference data used to classify patrons: the department codes known to Alma
+# and the ZIP codes that are not considered distance addresses.
+#
+
+import csv
+import os
+
+from bisect import bisect_right
+
+
+# Reference data already loaded, by loader and file path, with the modification
+# time and size of the file it was loaded from
+reference_data = {}
+
+
+class ZipCodes:
+    """
+    Set of ZIP codes with constant-time membership tests on the first five digits
+    of a ZIP code.
+
+    Each entry is a 5-digit ZIP code (a ZIP+4 code counts as its 5-digit ZIP),
+    a prefix of fewer than five digits standing for every ZIP code starting with
+    it (e.g. 972), or an inclusive range of 5-digit ZIP codes (e.g. 97201-97299).
+    """
+
+    def __init__(self, entries=()):
+        codes = set()
+        prefixes = set()
+        ranges = []
+
+        for entry in entries:
+            entry = entry.strip()
+            if not entry:
+                continue
+            if '-' in entry:
+                start, end = [part.strip() for part in entry.split('-', 1)]
+                if len(end) == 5:
+                    ranges.append((start, end))
+                else:
+                    codes.add(start[:5])
+            elif len(entry) < 5:
+                prefixes.add(entry)
+            else:
+                codes.add(entry[:5])
+
+        self.codes = frozenset(codes)
+        self.prefixes = frozenset(prefixes)
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in prefixes))
+        self.range_starts, self.range_ends = self.merge_ranges(ranges)
+
+    @staticmethod
+    def merge_ranges(ranges):
+        starts = []
+        ends = []
+
+        for start, end in sorted(ranges):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        return starts, ends
+
+    def __contains__(self, zip_code):
+        zip_code = zip_code[:5]
+
+        if zip_code in self.codes:
+            return True
+        for length in self.prefix_lengths:
+            if zip_code[:length] in self.prefixes:
+                return True
+        if self.range_starts:
+            index = bisect_right(self.range_starts, zip_code) - 1
+            if index >= 0 and zip_code <= self.range_ends[index]:
+                return True
+
+        return False
+
+    def __len__(self):
+        return len(self.codes) + len(self.prefixes) + len(self.range_starts)
+
+
+def load_department_codes_file(file_path):
+    file_contents = {}
+
+    csv_file = open(file_path)
+    csv_reader = csv.DictReader(csv_file, delimiter=',')
+    for row in csv_reader:
+        file_contents[row['code']] = row['label']
+    csv_file.close()
+
+    return file_contents
+
+
+def load_zip_codes_file(file_path):
+    text_file = open(file_path)
+    file_contents = ZipCodes(text_file.read().splitlines())
+    text_file.close()
+
+    return file_contents
+
+
+def load_reference_file(loader, file_path):
+    """
+    Return loader(file_path), reusing the data loaded by a previous call while the
+    file is unchanged. The data returned must not be modified by the caller.
+    """
+    stat = os.stat(file_path)
+    version = (stat.st_mtime, stat.st_size)
+    key = (loader.__name__, file_path)
+
+    if key not in reference_data or reference_data[key][0] != version:
+        reference_data[key] = (version, loader(file_path))
+
+    return reference_data[key][1]
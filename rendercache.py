@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Cache of the XML documents rendered by the patron load, kept in a SQLite
+# database. Each chunk of patrons is stored under a hash of its records and of
+# the renderer, so a chunk whose records have not changed since a previous run
+# is written from the cache instead of being rendered again. Documents are
+# compressed, and entries that have not been used for a while are deleted.
+#
+
+import logging
+import sqlite3
+import sys
+import zlib
+
+from datetime import date, timedelta
+from optparse import OptionParser
+
+
+# Entries are deleted when they have not been used for this many days
+RETENTION_DAYS = 7
+# Fast compression: the XML shrinks about tenfold even at the lowest level
+COMPRESSION_LEVEL = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    chunk_key TEXT NOT NULL,
+    part INTEGER NOT NULL,
+    records INTEGER NOT NULL,
+    document BLOB NOT NULL,
+    used TEXT NOT NULL,
+    PRIMARY KEY (chunk_key, part)
+);
+CREATE INDEX IF NOT EXISTS documents_used ON documents (used);
+"""
+
+
+class RenderCache:
+    """
+    Rendered documents of each chunk, as (record count, XML document) tuples,
+    keyed by the hash of the chunk.
+    """
+
+    def __init__(self, file_path, timeout=30):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.hits = self.misses = 0
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, chunk_key):
+        """Return the documents of a chunk, or None, marking them as used today."""
+        rows = self.connection.execute(
+            "SELECT records, document FROM documents WHERE chunk_key = ? ORDER BY part",
+            (chunk_key,)).fetchall()
+        if not rows:
+            self.misses += 1
+            return None
+
+        with self.connection:
+            self.connection.execute("UPDATE documents SET used = ? WHERE chunk_key = ?",
+                                    (date.today().isoformat(), chunk_key))
+        self.hits += 1
+        return [(records, zlib.decompress(document)) for records, document in rows]
+
+    def put(self, chunk_key, documents):
+        today = date.today().isoformat()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                [(chunk_key, part, records, zlib.compress(document, COMPRESSION_LEVEL), today)
+                 for part, (records, document) in enumerate(documents)])
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def prune(self, retention_days=RETENTION_DAYS):
+        """Delete the documents not used in the last retention_days days."""
+        cutoff = (date.today() - timedelta(days=retention_days)).isoformat()
+        with self.connection:
+            deleted = self.connection.execute("DELETE FROM documents WHERE used < ?", (cutoff,)).rowcount
+        if deleted:
+            logging.info("Deleted %s documents unused since %s from %s." % (deleted, cutoff, self.file_path))
+
+        return deleted
+
+    def stats(self):
+        return self.connection.execute(
+            "SELECT COUNT(DISTINCT chunk_key), COALESCE(SUM(records), 0), COALESCE(SUM(LENGTH(document)), 0) "
+            "FROM documents").fetchone()
+
+
+def main(argv):
+    usage = "usage: %prog [options] stats | prune"
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--file',
+                      help='Cache file',
+                      dest='file_path')
+    parser.add_option('-r', '--retention-days',
+                      help='Age in days of the unused documents deleted by prune (default: %s)' % RETENTION_DAYS,
+                      type='int',
+                      default=RETENTION_DAYS,
+                      dest='retention_days')
+
+    (options, args) = parser.parse_args()
+
+    if options.file_path is None or len(args) != 1:
+        parser.error('Cache file or command missing.')
+
+    cache = RenderCache(options.file_path)
+    command = args[0]
+
+    try:
+        if command == 'stats':
+            print('%s chunks, %s records, %s compressed bytes' % cache.stats())
+        elif command == 'prune':
+            print('%s documents deleted' % cache.prune(options.retention_days))
+        else:
+            parser.error('Unknown command.')
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
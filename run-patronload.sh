@@ -7,10 +7,21 @@ APPHOME=${PWD}
 ## Load process configuration files
 . config/patronload.config
 
+# Submit the Python scripts to the job server when it is running
+if venv/bin/python patronloadd.py ping > /dev/null 2>&1; then
+        python_run="venv/bin/python patronloadd.py run"
+else
+        python_run="venv/bin/python"
+fi
+
 if [ ! -d $config_tempfolder ]; then
 	mkdir $config_tempfolder
 fi
 
+if [ ! -d $config_previous_folder ]; then
+	mkdir $config_previous_folder
+fi
+
 # Retrieve patron data file from the Banner SFTP server.
 cd $config_tempfolder
 sftp $config_banner_sftpuser@$config_banner_sftphost << EOF
@@ -22,23 +33,20 @@ EOF
 # Retrieve the non-distance ZIP codes file from DFS
 smbclient -U $config_ad_user -c "cd $config_ad_path; get $config_ad_zipcodefilename; get $config_ad_deptcodefilename; exit" //$config_ad_fileserver/$config_ad_share "$config_ad_pass"
 
-# Sanitize the patron data file
+# Quoting defects of the patron data file are repaired as the Python scripts read it
 cd $APPHOME
 
-## Patron load - Generate Alma XML files
+## Patron load - Generate the Alma XML files in the ZIP file in the SFTP location
 if [[ $config_debug ]]; then
         echo "Running the patron load (`date`)..."
-        ./venv/bin/python patronload.py -r "$config_email_recipients" -d
+        $python_run patronload.py -r "$config_email_recipients" -s -p $config_previous_folder/$config_snapshotfilename -z $config_sftplocation/$config_zipfilename -d
 else
-        ./venv/bin/python patronload.py -r "$config_email_recipients"
+        $python_run patronload.py -r "$config_email_recipients" -s -p $config_previous_folder/$config_snapshotfilename -z $config_sftplocation/$config_zipfilename
 fi
 
-# Generate the ZIP file in the SFTP location
+# Archive the files used for this load, with the manifest of the XML files sent
 cd $config_tempfolder
-zip -q $config_sftplocation/$config_zipfilename *-${config_xmlfilenamebase}
-
-# Archive the files used for this load
-zip $config_archivelocation/$config_archivefilename $config_ad_zipcodefilename $config_banner_filename
+zip $config_archivelocation/$config_archivefilename $config_ad_zipcodefilename $config_banner_filename userdata-manifest.csv
 
 if [[ $config_debug ]]; then
         echo "Finished patron load (`date`)."
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Fixtures shared by the tests: the scripts' folder on the import path and a
+# local stand-in for the Alma Users API.
+#
+
+import importlib.util
+import os
+import re
+import sys
+import threading
+import time
+
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+sys.path.insert(0, APP_FOLDER)
+
+# Day of the load of the patron data fixture, which sets the expiration dates of the expected XML
+LOAD_DATE = date(2026, 9, 15)
+
+USER_XML = ('<?xml version="1.0" encoding="UTF-8"?><user><primary_id>%s</primary_id><user_group>%s</user_group>'
+            '<contact_info><addresses><address><line1>1 Main St</line1><email>patron@pdx.edu</email>'
+            '</address></addresses></contact_info></user>')
+
+
+def load_script(name):
+    """Import a script of the app folder whose name is not a module name, e.g. change-patron-group.py."""
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(APP_FOLDER, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class AlmaStub:
+    """
+    Users API answering from a dict of user groups. Responses queued for a user
+    with fail() (status, headers and delay) are returned before the user record.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.failures = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ 'poll_interval': 0.05 })
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fail(self, primary_id, status, headers=None, delay=0):
+        self.failures.setdefault(primary_id, []).append((status, headers or {}, delay))
+
+    def count(self, method, primary_id=None):
+        return len([request for request in self.requests
+                    if request[0] == method and primary_id in (None, request[1])])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body=b'', headers=None):
+                try:
+                    self.send_response(status)
+                    for name, value in (headers or {}).items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # The client timed out before a delayed reply
+                    pass
+
+            def primary_id(self):
+                return self.path.split('?')[0].rsplit('/', 1)[-1]
+
+            def next_failure(self, primary_id):
+                with stub.lock:
+                    stub.requests.append((self.command, primary_id))
+                    failures = stub.failures.get(primary_id)
+                    return failures.pop(0) if failures else None
+
+            def do_GET(self):
+                primary_id = self.primary_id()
+                failure = self.next_failure(primary_id)
+                if failure is not None:
+                    status, headers, delay = failure
+                    time.sleep(delay)
+                    return self.reply(status, b'failure', headers)
+                if primary_id not in stub.groups:
+                    return self.reply(400, b'<web_service_result><errorsExist>true</errorsExist></web_service_result>')
+
+                body = (USER_XML % (primary_id, stub.groups[primary_id])).encode('utf-8')
+                etag = '"%s"' % stub.groups[primary_id]
+                if self.headers.get('If-None-Match') == etag:
+                    return self.reply(304, headers={ 'ETag': etag })
+                self.reply(200, body, { 'Content-Type': 'application/xml', 'ETag': etag })
+
+            def do_PUT(self):
+                primary_id = self.primary_id()
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                failure = self.next_failure(primary_id)
+                if failure is not None:
+                    return self.reply(failure[0], b'failure', failure[1])
+
+                stub.groups[primary_id] = re.search(r'<user_group>(.*?)</user_group>', body.decode('utf-8')).group(1)
+                self.reply(200, body, { 'Content-Type': 'application/xml' })
+
+        return Handler
+
+
+@pytest.fixture
+def alma():
+    stub = AlmaStub()
+    yield stub
+    stub.close()
+
+
+class Sleeps:
+    """
+    Stand-in for the time module of almaapi recording the retry delays instead
+    of waiting. Calls are not rate limited, so that every delay is a retry delay.
+    """
+
+    def __init__(self):
+        self.delays = []
+
+    def sleep(self, seconds):
+        self.delays.append(seconds)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    import almaapi
+    recorder = Sleeps()
+    monkeypatch.setattr(almaapi, 'time', recorder)
+    monkeypatch.setattr(almaapi.RateLimiter, 'wait', lambda self: None)
+    return recorder
+
+
+class LoadDate(date):
+    @classmethod
+    def today(cls):
+        return LOAD_DATE
+
+
+@pytest.fixture
+def fixture_files(monkeypatch):
+    """Point patronload at the patron data fixture, loaded on LOAD_DATE."""
+    import patronload
+    monkeypatch.setattr(patronload, 'date', LoadDate)
+    monkeypatch.setattr(patronload.ExpirationTable, 'current', None)
+    monkeypatch.setattr(patronload, 'CURRENT_PATRON_DATA_FILE', os.path.join(FIXTURES_FOLDER, 'patrondata.csv'))
+    monkeypatch.setattr(patronload, 'DEPARTMENTS_FILE', os.path.join(FIXTURES_FOLDER, 'departments.csv'))
+    monkeypatch.setattr(patronload, 'ZIP_CODES_FILE', os.path.join(FIXTURES_FOLDER, 'non-distance-zipcodes.txt'))
+    return patronload
+
+
+@pytest.fixture
+def patron_data(fixture_files):
+    """Patrons of the patron data fixture, keyed by barcode."""
+    patronload = fixture_files
+    non_distance_zip_codes = patronload.load_zip_codes_file(patronload.ZIP_CODES_FILE)
+    return patronload.load_patron_data_file(patronload.CURRENT_PATRON_DATA_FILE, non_distance_zip_codes)
+
+
+def expected_user_xml():
+    with open(os.path.join(FIXTURES_FOLDER, 'userdata.xml'), 'rb') as xml_file:
+        return xml_file.read()
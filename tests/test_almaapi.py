@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import requests
+
+from almaapi import DEFAULT_TIMEOUT, AlmaAPIError, AlmaUsersClient
+from usercache import UserCache
+
+
+def test_429_is_retried_after_the_retry_after_delay(alma, sleeps):
+    alma.groups['900000001'] = 'undergrad'
+    alma.fail('900000001', 429, { 'Retry-After': '3' })
+    client = AlmaUsersClient('key', alma.url)
+
+    user = client.get_user('900000001')
+
+    assert user.find('user_group').string == 'undergrad'
+    assert alma.count('GET') == 2
+    assert sleeps.delays == [3.0]
+
+
+def test_5xx_is_retried_with_exponential_backoff(alma, sleeps):
+    alma.groups['900000001'] = 'undergrad'
+    for status in [500, 502, 503]:
+        alma.fail('900000001', status)
+    client = AlmaUsersClient('key', alma.url)
+
+    user = client.get_user('900000001')
+
+    assert user.find('user_group').string == 'undergrad'
+    assert alma.count('GET') == 4
+    assert [int(delay * 2) for delay in sleeps.delays] == [1, 2, 4]
+
+
+def test_5xx_fails_after_max_retries(alma, sleeps):
+    alma.groups['900000001'] = 'undergrad'
+    for attempt in range(3):
+        alma.fail('900000001', 503)
+    client = AlmaUsersClient('key', alma.url, max_retries=2)
+
+    with pytest.raises(AlmaAPIError) as error:
+        client.get_user('900000001')
+
+    assert error.value.status_code == 503
+    assert alma.count('GET') == 3
+
+
+def test_requests_time_out_by_default(alma):
+    client = AlmaUsersClient('key', alma.url)
+    calls = []
+    client.session.request = lambda method, url, **kwargs: calls.append(kwargs) or requests.Response()
+
+    client.request('GET', alma.url)
+
+    assert client.timeout == DEFAULT_TIMEOUT
+    assert calls[0]['timeout'] == DEFAULT_TIMEOUT
+
+
+def test_read_timeout_is_retried(alma, sleeps):
+    alma.groups['900000001'] = 'undergrad'
+    alma.fail('900000001', 200, delay=0.5)
+    client = AlmaUsersClient('key', alma.url, timeout=(1, 0.1))
+
+    user = client.get_user('900000001')
+
+    assert user.find('user_group').string == 'undergrad'
+    assert alma.count('GET') == 2
+    assert len(sleeps.delays) == 1
+
+
+def test_read_timeout_fails_after_max_retries(alma, sleeps):
+    alma.groups['900000001'] = 'undergrad'
+    alma.fail('900000001', 200, delay=0.5)
+    client = AlmaUsersClient('key', alma.url, max_retries=0, timeout=(1, 0.1))
+
+    with pytest.raises(requests.Timeout):
+        client.get_user('900000001')
+
+
+def test_user_already_in_group_is_not_updated(alma, sleeps):
+    alma.groups['900000001'] = 'expired'
+    client = AlmaUsersClient('key', alma.url)
+
+    assert client.change_group('900000001', 'expired') == ('expired', 200, False)
+    assert alma.count('PUT') == 0
+
+
+def test_user_group_is_changed(alma, sleeps):
+    alma.groups['900000001'] = 'undergrad'
+    client = AlmaUsersClient('key', alma.url)
+
+    assert client.change_group('900000001', 'expired') == ('undergrad', 200, True)
+    assert alma.groups['900000001'] == 'expired'
+
+
+def test_change_revalidates_fresh_cached_record(alma, sleeps, tmp_path):
+    alma.groups['900000001'] = 'undergrad'
+    cache = UserCache(str(tmp_path / 'users.db'))
+    client = AlmaUsersClient('key', alma.url, cache=cache)
+    client.get_user('900000001')
+    # Changed in Alma after the record was cached
+    alma.groups['900000001'] = 'faculty'
+
+    assert client.change_group('900000001', 'expired') == ('faculty', 200, True)
+    assert alma.groups['900000001'] == 'expired'
+    assert alma.count('GET') == 2
+    cache.close()
+
+
+def test_fresh_cached_user_in_group_is_not_fetched(alma, sleeps, tmp_path):
+    alma.groups['900000001'] = 'expired'
+    cache = UserCache(str(tmp_path / 'users.db'))
+    client = AlmaUsersClient('key', alma.url, cache=cache)
+    client.get_user('900000001')
+
+    assert client.change_group('900000001', 'expired') == ('expired', 200, False)
+    assert (alma.count('GET'), alma.count('PUT')) == (1, 0)
+    assert cache.hits == 1
+    cache.close()
+
+
+def test_change_of_cached_user_moved_in_alma_is_skipped(alma, sleeps, tmp_path):
+    alma.groups['900000001'] = 'undergrad'
+    cache = UserCache(str(tmp_path / 'users.db'))
+    client = AlmaUsersClient('key', alma.url, cache=cache)
+    client.get_user('900000001')
+    # Moved to the target group in Alma after the record was cached
+    alma.groups['900000001'] = 'expired'
+
+    assert client.change_group('900000001', 'expired') == ('expired', 200, False)
+    assert (alma.count('GET'), alma.count('PUT')) == (2, 0)
+    cache.close()
+
+
+def test_replaced_record_is_counted_once(tmp_path):
+    cache = UserCache(str(tmp_path / 'users.db'))
+    cache.put('900000001', 'x' * 100)
+    cache.put('900000001', 'x' * 60)
+
+    assert cache.size == cache.get_size() == 60
+    cache.close()
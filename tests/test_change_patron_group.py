@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import zipfile
+
+from xml.etree import ElementTree
+
+import pytest
+
+import almaapi
+
+from conftest import load_script
+
+
+@pytest.fixture
+def change_patron_group(alma, sleeps, monkeypatch):
+    """Run change-patron-group.py against the stub, returning its exit status."""
+    script = load_script('change-patron-group')
+    monkeypatch.setattr(script, 'AlmaUsersClient', functools.partial(almaapi.AlmaUsersClient, base_url=alma.url))
+
+    def run(*args):
+        argv = ['change-patron-group.py', '-k', 'key'] + list(args)
+        monkeypatch.setattr('sys.argv', argv)
+        try:
+            script.main(argv)
+        except SystemExit as exit:
+            return exit.code
+        return 0
+
+    return run
+
+
+def output_lines(capsys):
+    return sorted(line.split('\t') for line in capsys.readouterr().out.splitlines())
+
+
+def test_each_barcode_is_reported(alma, change_patron_group, capsys):
+    alma.groups.update({ '900000001': 'undergrad', '900000002': 'expired', '900000003': 'faculty' })
+    alma.fail('900000001', 429, { 'Retry-After': '1' })
+    alma.fail('900000003', 503)
+
+    assert change_patron_group('-g', 'expired', '900000001', '900000002', '900000003') == 0
+    assert output_lines(capsys) == [
+        ['900000001', 'expired', 'changed', '200', 'undergrad'],
+        ['900000002', 'expired', 'unchanged', '200', 'expired'],
+        ['900000003', 'expired', 'changed', '200', 'faculty'],
+    ]
+    assert alma.count('PUT') == 2
+
+
+def test_failed_change_sets_exit_status(alma, change_patron_group, capsys):
+    alma.groups.update({ '900000001': 'undergrad' })
+
+    assert change_patron_group('-g', 'expired', '900000001', '900000099') == 1
+    assert output_lines(capsys) == [
+        ['900000001', 'expired', 'changed', '200', 'undergrad'],
+        ['900000099', 'expired', 'failed', '400', ''],
+    ]
+
+
+def test_journal_skips_completed_changes(alma, change_patron_group, capsys, tmp_path):
+    alma.groups.update({ '900000001': 'undergrad', '900000002': 'undergrad' })
+    alma.fail('900000002', 400)
+    journal = str(tmp_path / 'journal.db')
+
+    assert change_patron_group('-j', journal, '--run-id', 'run', '900000001', '900000002') == 1
+    capsys.readouterr()
+
+    assert change_patron_group('-j', journal, '--run-id', 'run', '900000001', '900000002') == 0
+    assert output_lines(capsys) == [['900000002', 'expired', 'changed', '200', 'undergrad']]
+    assert alma.count('GET', '900000001') == 1
+
+
+def test_large_batch_is_exported(alma, change_patron_group, capsys, tmp_path):
+    bulk_output = str(tmp_path / 'groupchanges.zip')
+
+    assert change_patron_group('--bulk-output', bulk_output, '--bulk-threshold', '2', '900000001',
+                               '900000002,faculty-expired') == 0
+    assert output_lines(capsys) == [
+        ['900000001', 'expired', 'exported', '', ''],
+        ['900000002', 'faculty-expired', 'exported', '', ''],
+    ]
+    with zipfile.ZipFile(bulk_output) as bulk_zip:
+        assert bulk_zip.namelist() == ['1-groupchanges.xml']
+        users = ElementTree.fromstring(bulk_zip.read('1-groupchanges.xml'))
+    assert [(user.findtext('primary_id'), user.findtext('user_group')) for user in users] == [
+        ('900000001', 'expired'), ('900000002', 'faculty-expired')]
+    assert alma.requests == []
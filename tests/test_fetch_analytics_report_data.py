@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+import pytest
+
+import almaapi
+
+from conftest import load_script
+
+
+REPORT_PATH = '/almaws/v1/analytics/reports'
+
+PAGE_XML = ('<?xml version="1.0" encoding="UTF-8"?><report><QueryResult>%s<IsFinished>%s</IsFinished>'
+            '<ResultXml><rowset xmlns="urn:schemas-microsoft-com:xml-analysis:rowset">%s</rowset>'
+            '</ResultXml></QueryResult></report>')
+ROW_XML = '<Row><Column0>0</Column0><Column1>%s</Column1><Column2>%s</Column2></Row>'
+
+
+class AnalyticsStub:
+    """
+    Analytics API serving a report of rows in pages of the requested size. As in
+    Alma, only the first page carries the resumption token, which the next
+    requests send back.
+    """
+    token = 'TOKEN'
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ 'poll_interval': 0.05 })
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def page(self, number, limit):
+        rows = self.rows[number * limit:(number + 1) * limit]
+        finished = (number + 1) * limit >= len(self.rows)
+        token = '<ResumptionToken>%s</ResumptionToken>' % self.token if number == 0 else ''
+        rows_xml = ''.join(ROW_XML % (barcode, escape(name)) for barcode, name in rows)
+        return PAGE_XML % (token, 'true' if finished else 'false', rows_xml)
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                params = dict((name, values[0]) for name, values in parse_qs(urlparse(self.path).query).items())
+                stub.requests.append(params)
+                if params.get('token', stub.token) != stub.token:
+                    body = b'unknown token'
+                    self.send_response(400)
+                else:
+                    # Pages are numbered by the requests made with the token
+                    number = len([request for request in stub.requests if 'token' in request])
+                    body = stub.page(number, int(params['limit'])).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+@pytest.fixture
+def analytics():
+    stubs = []
+
+    def start(rows):
+        stubs.append(AnalyticsStub(rows))
+        return stubs[-1]
+
+    yield start
+    for stub in stubs:
+        stub.close()
+
+
+def report_rows(count):
+    return [('9000%05d' % number, 'Name & %s' % number) for number in range(count)]
+
+
+def test_report_rows_are_read_across_pages(analytics, sleeps):
+    stub = analytics(report_rows(60))
+    client = almaapi.AlmaAnalyticsClient('key', stub.url, page_size=25)
+
+    rows = list(client.iter_report(REPORT_PATH))
+
+    assert [(row['Column1'], row['Column2']) for row in rows] == report_rows(60)
+    assert list(rows[0].keys()) == ['Column0', 'Column1', 'Column2']
+    assert stub.requests == [{ 'limit': '25' }, { 'limit': '25', 'token': 'TOKEN' },
+                             { 'limit': '25', 'token': 'TOKEN' }]
+
+
+def test_next_page_is_prefetched(analytics, sleeps):
+    stub = analytics(report_rows(60))
+    client = almaapi.AlmaAnalyticsClient('key', stub.url, page_size=25)
+    rows = client.iter_report(REPORT_PATH)
+
+    next(rows)
+    deadline = time.time() + 5
+    while len(stub.requests) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert len(stub.requests) == 2
+    assert len(list(rows)) == 59
+
+
+def test_single_page_report_makes_one_request(analytics, sleeps):
+    stub = analytics(report_rows(25))
+    client = almaapi.AlmaAnalyticsClient('key', stub.url, page_size=25)
+
+    assert len(list(client.iter_report(REPORT_PATH))) == 25
+    assert len(stub.requests) == 1
+
+
+@pytest.fixture
+def fetch_analytics_report_data(analytics, sleeps, monkeypatch):
+    """Run fetch-analytics-report-data.py against a stub report, returning its exit status."""
+    script = load_script('fetch-analytics-report-data')
+    stub = analytics(report_rows(30))
+
+    def run(*args):
+        monkeypatch.setattr(script, 'AlmaAnalyticsClient',
+                            functools.partial(almaapi.AlmaAnalyticsClient, base_url=stub.url))
+        argv = ['fetch-analytics-report-data.py', '-k', 'key', '-p', REPORT_PATH, '-f', 'Column1'] + list(args)
+        monkeypatch.setattr('sys.argv', argv)
+        try:
+            script.main(argv)
+        except SystemExit as exit:
+            return exit.code
+        return 0
+
+    return run
+
+
+@pytest.mark.parametrize('page_size, exit_code', [('24', 2), ('25', 0), ('1000', 0), ('1001', 2)])
+def test_page_size_is_checked(fetch_analytics_report_data, capsys, page_size, exit_code):
+    assert fetch_analytics_report_data('-l', page_size) == exit_code
+
+    output = capsys.readouterr()
+    if exit_code == 0:
+        assert output.out.split() == [barcode for barcode, name in report_rows(30)]
+    else:
+        assert 'between 25 and 1000' in output.err
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import socketserver
+import sys
+import threading
+
+import pytest
+
+import notify
+
+from notify import Digest, Notifier
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """
+    Mail server keeping the messages it accepts, with the number of connections
+    made. It closes a connection after drop_after messages, and refuses the
+    recipients listed in refused.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after=None, refused=()):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.drop_after = drop_after
+        self.refused = refused
+        self.connections = 0
+        self.messages = []
+        self.host = '127.0.0.1:%s' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={ 'poll_interval': 0.05 })
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        messages = 0
+        self.reply('220 stub')
+
+        for line in self.rfile:
+            command = line.decode('ascii').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            elif verb == 'RCPT' and any(recipient in command for recipient in self.server.refused):
+                self.reply('550 refused')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append(data.decode('utf-8'))
+                self.reply('250 accepted')
+                messages += 1
+                if messages == self.server.drop_after:
+                    return
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture
+def smtp_server():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(SMTPStub(**kwargs))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def message(recipient, number):
+    digest = Digest('Notice %s' % number)
+    digest.add('Expirations', ['Assigning patron with barcode %s to group expired' % number])
+    return digest.message([recipient])
+
+
+def test_messages_share_one_connection(smtp_server):
+    server = smtp_server()
+    notifier = Notifier(server.host)
+    for number in range(3):
+        notifier.send(message('staff@pdx.edu', number))
+    notifier.close()
+
+    assert (notifier.sent, notifier.failed) == (3, 0)
+    assert server.connections == 1
+    assert ['Subject: Notice %s' % number in text for number, text in enumerate(server.messages)] == [True] * 3
+
+
+def test_reconnects_after_server_disconnected(smtp_server):
+    server = smtp_server(drop_after=2)
+    notifier = Notifier(server.host)
+    for number in range(5):
+        notifier.send(message('staff@pdx.edu', number))
+    notifier.close()
+
+    assert (notifier.sent, notifier.failed) == (5, 0)
+    assert len(server.messages) == 5
+    assert server.connections == 3
+
+
+def test_refused_messages_are_counted(smtp_server):
+    server = smtp_server(refused=['unknown@pdx.edu'])
+    notifier = Notifier(server.host)
+    notifier.send(message('staff@pdx.edu', 0))
+    notifier.send(message('unknown@pdx.edu', 1))
+    notifier.send(message('staff@pdx.edu', 2))
+    notifier.close()
+
+    assert (notifier.sent, notifier.failed) == (2, 1)
+    assert len(server.messages) == 2
+
+
+def test_unreachable_server_is_counted(smtp_server):
+    server = smtp_server()
+    host = server.host
+    server.close()
+    notifier = Notifier(host, timeout=1)
+    notifier.send(message('staff@pdx.edu', 0))
+    notifier.close()
+
+    assert (notifier.sent, notifier.failed) == (0, 1)
+
+
+def test_digest_of_group_change_lists(tmp_path, monkeypatch, capsys):
+    expirations = tmp_path / 'expirations.txt'
+    expirations.write_text('900000001\n900000002,faculty-expired\n\n900000003 student-expired\n')
+    argv = ['notify.py', '-n', '-s', 'Expirations', '-e', str(expirations)]
+    monkeypatch.setattr(sys, 'argv', argv)
+
+    notify.main(argv)
+
+    assert capsys.readouterr().err.splitlines() == [
+        'Expirations (3)',
+        '',
+        'Assigning patron with barcode 900000001 to group expired',
+        'Assigning patron with barcode 900000002 to group faculty-expired',
+        'Assigning patron with barcode 900000003 to group student-expired',
+    ]
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+from datetime import date, timedelta
+from xml.etree import ElementTree
+
+import pytest
+
+import notify
+
+from conftest import APP_FOLDER, FIXTURES_FOLDER, LOAD_DATE, expected_user_xml
+
+
+class MailServer:
+    """Stand-in for smtplib.SMTP keeping the messages sent."""
+    messages = []
+
+    def __init__(self, host, timeout=None):
+        pass
+
+    def send_message(self, message):
+        self.messages.append(message)
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def patronload_run(fixture_files, monkeypatch, tmp_path):
+    """Run patronload.py on the patron data fixture, writing to a temporary folder."""
+    patronload = fixture_files
+    monkeypatch.setattr(patronload, 'OUTPUT_FOLDER', str(tmp_path))
+    monkeypatch.setattr(notify.smtplib, 'SMTP', MailServer)
+    monkeypatch.setattr(MailServer, 'messages', [])
+
+    def run(*args):
+        patronload.main(['patronload.py', '-r', 'staff@pdx.edu'] + list(args))
+        return tmp_path
+
+    return run
+
+
+@pytest.mark.parametrize('args', [[], ['-s'], ['-e', 'direct'], ['-s', '-w', '2']])
+def test_load_writes_expected_xml(patronload_run, args):
+    output_folder = patronload_run(*args)
+
+    with open(os.path.join(str(output_folder), '1-userdata.xml'), 'rb') as xml_file:
+        assert xml_file.read() == expected_user_xml()
+    assert not os.path.exists(os.path.join(str(output_folder), '2-userdata.xml'))
+
+
+@pytest.mark.parametrize('args', [[], ['-s']])
+def test_first_record_of_duplicate_barcode_is_loaded(patronload_run, fixture_files, monkeypatch, tmp_path, args):
+    patron_data_file = str(tmp_path / 'patrondata.csv')
+    shutil.copyfile(os.path.join(FIXTURES_FOLDER, 'patrondata.csv'), patron_data_file)
+    with open(patron_data_file, 'ab') as csv_file:
+        csv_file.write(b'"GRADUATE","","900000001","Duplicate","Row","","2 Other St","","","Portland","OR","97201",'
+                       b'"","","duplicate@pdx.edu","","","","LIB Library","","","DUP1","","",""\r\n')
+    monkeypatch.setattr(fixture_files, 'CURRENT_PATRON_DATA_FILE', patron_data_file)
+    output_folder = patronload_run(*args)
+
+    with open(os.path.join(str(output_folder), '1-userdata.xml'), 'rb') as xml_file:
+        assert xml_file.read() == expected_user_xml()
+
+
+def test_zip_output_holds_expected_xml(patronload_run, tmp_path):
+    zip_path = str(tmp_path / 'userdata.zip')
+    patronload_run('-z', zip_path)
+
+    with zipfile.ZipFile(zip_path) as output_zip:
+        assert output_zip.namelist() == ['1-userdata.xml']
+        assert output_zip.read('1-userdata.xml') == expected_user_xml()
+
+
+def test_manifest_of_zip_output_is_kept_out_of_the_zip_folder(patronload_run, tmp_path):
+    zip_folder = tmp_path / 'sftp'
+    zip_folder.mkdir()
+    output_folder = patronload_run('-z', str(zip_folder / 'userdata.zip'))
+
+    assert os.listdir(str(zip_folder)) == ['userdata.zip']
+    with open(os.path.join(str(output_folder), 'userdata-manifest.csv')) as manifest_file:
+        assert list(csv.reader(manifest_file)) == [
+            ['filename', 'records', 'bytes', 'sha256'],
+            ['1-userdata.xml', '6', str(len(expected_user_xml())), hashlib.sha256(expected_user_xml()).hexdigest()],
+        ]
+
+
+def test_load_sends_one_digest(patronload_run):
+    patronload_run('-s')
+
+    assert len(MailServer.messages) == 1
+    text = MailServer.messages[0].get_payload()
+    assert 'ZZZ' in text
+    assert 'missing_street: 1' in text
+    assert 'missing_email: 1' in text
+    assert 'missing_username: 1' in text
+    assert '900000005' in text
+
+
+def test_scripts_import_their_dependencies_when_used():
+    code = ("import sys, almaapi, patronload; "
+            "print(' '.join(sorted(set(['jinja2', 'requests', 'bs4']) & set(sys.modules))))")
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=APP_FOLDER)
+
+    assert output.strip() == b''
+
+
+def written_barcodes(output_folder):
+    path = os.path.join(str(output_folder), '1-userdata.xml')
+    if not os.path.exists(path):
+        return []
+    return [user.findtext('primary_id') for user in ElementTree.parse(path).getroot()]
+
+
+def previous_export(tmp_path, load_date):
+    """Copy the patron data fixture as the export of a previous load."""
+    path = str(tmp_path / ('patrondata-%s.csv' % load_date.strftime('%Y%m%d')))
+    shutil.copyfile(os.path.join(FIXTURES_FOLDER, 'patrondata.csv'), path)
+    return path
+
+
+def test_delta_of_unchanged_export_writes_nothing(patronload_run, tmp_path):
+    previous_file = previous_export(tmp_path, LOAD_DATE - timedelta(days=1))
+
+    assert written_barcodes(patronload_run('--delta', previous_file)) == []
+
+
+def test_delta_writes_records_whose_expiration_rolled_over(patronload_run, tmp_path):
+    # Student expiration dates roll over on September 1
+    previous_file = previous_export(tmp_path, date(2026, 8, 31))
+
+    assert written_barcodes(patronload_run('--delta', previous_file)) == ['900000001', '900000003', '900000004']
+
+
+def test_delta_date_is_required_without_date_in_name(patronload_run, tmp_path):
+    previous_file = str(tmp_path / 'previous.csv')
+    shutil.copyfile(os.path.join(FIXTURES_FOLDER, 'patrondata.csv'), previous_file)
+
+    with pytest.raises(SystemExit):
+        patronload_run('--delta', previous_file)
+    assert written_barcodes(patronload_run('--delta', previous_file, '--delta-date', '2026-08-31')) == [
+        '900000001', '900000003', '900000004']
+
+
+@pytest.fixture
+def snapshot_run(patronload_run, fixture_files, monkeypatch, tmp_path):
+    """
+    Load a copy of the patron data fixture, edited by edit(lines), with
+    --delta against the snapshot updated by the previous run. Returns the
+    barcodes written and the barcodes listed as removed.
+    """
+    snapshot_file = str(tmp_path / 'patrons.db')
+    output_folder = tmp_path / 'output'
+    output_folder.mkdir()
+    monkeypatch.setattr(fixture_files, 'OUTPUT_FOLDER', str(output_folder))
+
+    def run(edit=None):
+        with open(os.path.join(FIXTURES_FOLDER, 'patrondata.csv'), 'rb') as csv_file:
+            lines = csv_file.readlines()
+        patron_data_file = tmp_path / 'patrondata.csv'
+        patron_data_file.write_bytes(b''.join(edit(lines) if edit else lines))
+        monkeypatch.setattr(fixture_files, 'CURRENT_PATRON_DATA_FILE', str(patron_data_file))
+        for filename in os.listdir(str(output_folder)):
+            os.remove(str(output_folder / filename))
+
+        delta = ['--delta', snapshot_file] if os.path.exists(snapshot_file) else []
+        patronload_run('-p', snapshot_file, *delta)
+        removed_file = output_folder / 'removed-barcodes.txt'
+        removed = removed_file.read_text().split() if removed_file.exists() else None
+        return written_barcodes(output_folder), removed
+
+    return run
+
+
+def test_snapshot_rerun_of_unchanged_export_writes_nothing(snapshot_run):
+    assert len(snapshot_run()[0]) == 6
+
+    assert snapshot_run() == ([], [])
+
+
+def test_snapshot_rerun_writes_changed_record(snapshot_run):
+    snapshot_run()
+
+    assert snapshot_run(lambda lines: [line.replace(b'1 ""Quoted"" Rd', b'2 ""Quoted"" Rd') for line in lines]) == (
+        ['900000002'], [])
+
+
+def test_snapshot_rerun_lists_removed_barcode(snapshot_run):
+    snapshot_run()
+
+    assert snapshot_run(lambda lines: [line for line in lines if b'"900000003"' not in line]) == ([], ['900000003'])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from referencedata import ZipCodes
+
+
+ZIP_CODES = ZipCodes(['97201', '97301-1234', '972', '97005 - 97010', '98000-98099', '98050-98199', '', '  '])
+
+
+@pytest.mark.parametrize('zip_code, expected', [
+    # 5-digit entries, matched by ZIP or ZIP+4
+    ('97201', True),
+    ('97201-0001', True),
+    ('972011234', True),
+    ('97202', True),
+    # A ZIP+4 entry stands for its 5-digit ZIP
+    ('97301', True),
+    ('97301-9999', True),
+    ('97302', False),
+    # Prefix
+    ('97299', True),
+    ('97300', False),
+    ('97', False),
+    # Range edges, with spaces around the dash of the entry
+    ('97004', False),
+    ('97005', True),
+    ('97010', True),
+    ('97010-9999', True),
+    ('97011', False),
+    # Overlapping ranges are merged
+    ('97999', False),
+    ('98000', True),
+    ('98099', True),
+    ('98100', True),
+    ('98199', True),
+    ('98200', False),
+    # No ZIP code
+    ('', False),
+])
+def test_zip_code_membership(zip_code, expected):
+    assert (zip_code in ZIP_CODES) == expected
+
+
+def test_prefix_overlapping_range():
+    zip_codes = ZipCodes(['97', '97100-98100'])
+
+    assert [zip_code in zip_codes for zip_code in ['96999', '97000', '97999', '98000', '98100', '98101']] == [
+        False, True, True, True, True, False]
+
+
+def test_blank_entries_are_skipped():
+    assert len(ZIP_CODES) == 5
+    assert len(ZipCodes(['', ' ', '\t'])) == 0
+    assert '' not in ZipCodes([''])
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from outputfiles import OutputFolder
+from rendercache import RenderCache
+
+from conftest import expected_user_xml
+
+
+@pytest.fixture
+def render_cache(tmp_path):
+    cache = RenderCache(str(tmp_path / 'render-cache.db'))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def write_load(fixture_files, render_cache, tmp_path):
+    """Write patrons through the render cache in the chunks of a --render-cache load, returning the XML files."""
+    patronload = fixture_files
+    runs = []
+
+    def write(patron_data, chunk_records=patronload.CACHE_CHUNK_RECORDS, engine='jinja'):
+        folder = tmp_path / ('run-%s' % len(runs))
+        folder.mkdir()
+        runs.append(folder)
+        writer = patronload.PatronFileWriter(OutputFolder(str(folder)), engine=engine, cache=render_cache)
+        for chunk in patronload.stable_patron_chunks(patron_data.values(), chunk_records):
+            writer.write(chunk)
+        writer.close()
+
+        documents = []
+        for number in range(1, len(os.listdir(str(folder))) + 1):
+            documents.append((folder / ('%s-userdata.xml' % number)).read_bytes())
+        return documents
+
+    return write
+
+
+@pytest.mark.parametrize('engine', ['jinja', 'direct'])
+def test_cached_render_matches_fresh_render(write_load, render_cache, patron_data, engine):
+    assert write_load(patron_data, engine=engine) == [expected_user_xml()]
+    assert (render_cache.hits, render_cache.misses) == (0, 1)
+
+    assert write_load(patron_data, engine=engine) == [expected_user_xml()]
+    assert (render_cache.hits, render_cache.misses) == (1, 1)
+
+
+def test_changed_patron_invalidates_its_chunk_only(write_load, render_cache, patron_data):
+    first = write_load(patron_data, chunk_records=2)
+    chunks = render_cache.misses
+    assert chunks > 1
+
+    patron_data['900000003'].address_line1 = '5 Hawthorne Blvd'
+    second = write_load(patron_data, chunk_records=2)
+
+    assert (render_cache.hits, render_cache.misses) == (chunks - 1, chunks + 1)
+    changed = [number for number, (before, after) in enumerate(zip(first, second)) if before != after]
+    assert len(changed) == 1
+    assert b'<primary_id>900000003</primary_id>' in second[changed[0]]
+    assert b'5 Hawthorne Blvd' in second[changed[0]]
+    # The changed chunk is rendered afresh, and then cached
+    assert write_load(patron_data, chunk_records=2) == second
+    assert render_cache.hits == 2 * chunks - 1
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from xml.etree import ElementTree
+
+import pytest
+
+from conftest import expected_user_xml
+
+
+@pytest.mark.parametrize('engine', ['jinja', 'direct'])
+def test_engine_output_matches_expected_xml(fixture_files, patron_data, engine):
+    renderer = fixture_files.UserXMLRenderer(engine)
+
+    assert renderer.document(patron_data) == expected_user_xml()
+
+
+@pytest.mark.parametrize('engine', ['jinja', 'direct'])
+def test_records_concatenate_to_the_document(fixture_files, patron_data, engine):
+    renderer = fixture_files.UserXMLRenderer(engine)
+    records = list(renderer.records(patron_data))
+
+    assert len(records) == len(patron_data)
+    assert renderer.start + b''.join(records) + renderer.end == expected_user_xml()
+
+
+def test_expected_xml_keeps_special_characters():
+    users = dict((user.findtext('primary_id'), user) for user in ElementTree.fromstring(expected_user_xml()))
+
+    assert users['900000001'].findtext('full_name') == u"Siobhán O'Brien"
+    assert users['900000001'].findtext('contact_info/addresses/address/line1') == '12 <Main> St & Annex'
+    assert users['900000001'].findtext('contact_info/emails/email/email_address') == "siobhan.o'brien@pdx.edu"
+    assert users['900000002'].findtext('middle_name') == 'Q & A'
+    assert users['900000002'].findtext('full_name') == 'Al Smith "Smitty"'
+    assert users['900000002'].findtext('contact_info/addresses/address/line1') == '1 "Quoted" Rd'
+    assert users['900000002'].findtext('contact_info/emails/email/email_address') == 'al&co@gmail.com'
+    assert users['900000003'].findtext('first_name') == 'Jo <Jay>'
+    # Rows without a street, an email or a username are rejected
+    assert sorted(users) == ['900000001', '900000002', '900000003', '900000004', '900000005', '900000006']
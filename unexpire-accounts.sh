@@ -7,10 +7,21 @@ APPHOME=${PWD}
 ## Load process configuration files
 . config/patronload.config
 
+# Submit the Python scripts to the job server when it is running
+if venv/bin/python patronloadd.py ping > /dev/null 2>&1; then
+        python_run="venv/bin/python patronloadd.py run"
+else
+        python_run="venv/bin/python"
+fi
+
 if [ ! -d $config_tempfolder ]; then
         mkdir $config_tempfolder
 fi
 
+if [ ! -d $config_previous_folder ]; then
+        mkdir $config_previous_folder
+fi
+
 # Retrieve patron data file from the Banner SFTP server
 # sshpass is not ideal, but key-based ssh auth wasn't a possibility
 cd $config_tempfolder
@@ -25,25 +36,9 @@ EOF
 # Retrieve the non-distance ZIP codes file from DFS
 smbclient -U $config_ad_user -c "cd $config_ad_path; get $config_ad_zipcodefilename; get $config_ad_deptcodefilename; exit" //$config_ad_fileserver/$config_ad_share "$config_ad_pass"
 
-# Sanitize the patron data file
+# Quoting defects of the patron data file are repaired as the Python scripts read it
 cd $APPHOME
-sed -i -e 's/\([0-9]"\)"/\1/g' $config_tempfolder/$config_banner_filename
-
 
-declare -A affected_users
-
-#todo: make this dynamic
-declare -A patron_types
-patron_types=(
-        ["FACULTY"]="faculty"
-        ["EMERITUS"]="emeritus"
-        ["GRADASSISTANT"]="gradasst"
-        ["GRADUATE"]="grad"
-        ["HONOR"]="honors"
-        ["UNDERGRADUATE"]="undergrad"
-        ["HIGHSCHOOL"]="highschool"
-        ["STAFF"]="staff"
-)
 
 if [[ $config_debug ]]; then
         echo "python fetch-analytics-report-data.py -k ${config_alma_analitycs_api_key} -p ${config_alma_analytics_expired_group_members_report_path} -f ${config_alma_analytics_unexpirations_barcode_field}"
@@ -54,48 +49,31 @@ if [[ $config_debug ]]; then
         echo "Processing unexpirations (`date`)..."
 fi
 
-venv/bin/python ./fetch-analytics-report-data.py -k ${config_alma_analitycs_api_key} -p ${config_alma_analytics_expired_group_members_report_path} -f ${config_alma_analytics_unexpirations_barcode_field} > $config_tempfolder/$config_alma_expired_patrons_list
-for barcode in `cat $config_tempfolder/$config_alma_expired_patrons_list`; do
-	if [[ $config_debug ]]; then
-        	echo "Processing ${barcode}..."
-	fi
-        if [ $(grep -ic ${barcode} ${config_tempfolder}/${config_banner_filename}) -gt 0 ]; then 
-                zip_code="$(grep ${barcode} ${config_tempfolder}/${config_banner_filename} | awk -F, '{print $12}' | sed -e 's/\"//g' | cut -c1-5)"
-
-                if [[ $zip_code =~ ^[0-9]{5}([-][0-9]{4})?$ ]]; then
-                        patron_group=${patron_types[$(grep ${barcode} ${config_tempfolder}/${config_banner_filename} | awk -F, '{print $1}' | sed -e 's/\"//g')]}
-                        if [ $(grep -ic ${zip_code} ${config_tempfolder}/${config_ad_zipcodefilename}) -eq 0 ]; then
-                                patron_group="${patron_group}-distance"
-                        fi
-
-                        if [[ $config_do_unexpirations ]]; then
-                                venv/bin/python change-patron-group.py -g ${patron_group} -k ${config_alma_analitycs_api_key} ${barcode}
-                        else
-                                echo "venv/bin/python change-patron-group.py -g ${patron_group} -k ${config_alma_analitycs_api_key} ${barcode}"
-                        fi
-                        affected_users[$barcode]=$patron_group
-                fi
-        fi
-done
+$python_run fetch-analytics-report-data.py -k ${config_alma_analitycs_api_key} -p ${config_alma_analytics_expired_group_members_report_path} -f ${config_alma_analytics_unexpirations_barcode_field} > $config_tempfolder/$config_alma_expired_patrons_list
+$python_run find-unexpirations.py -b ${config_tempfolder}/${config_banner_filename} -z ${config_tempfolder}/${config_ad_zipcodefilename} $config_tempfolder/$config_alma_expired_patrons_list > $config_tempfolder/$config_alma_unexpirations_list
+
+# Large batches of changes are left to the dedicated SIS import profile, when there is one
+bulk_options=""
+if [[ $config_group_change_sftplocation ]]; then
+        bulk_options="--bulk-output $config_group_change_sftplocation/$config_unexpirations_zipfilename --bulk-threshold $config_group_change_bulk_threshold"
+fi
+
+if [[ $config_do_unexpirations ]]; then
+        $python_run change-patron-group.py -j $config_previous_folder/$config_group_change_journal --cache $config_previous_folder/$config_user_cache $bulk_options --run-id unexpire-$(date +"%Y%m%d") -k ${config_alma_analitycs_api_key} -f $config_tempfolder/$config_alma_unexpirations_list
+else
+        echo "$python_run change-patron-group.py -j $config_previous_folder/$config_group_change_journal --cache $config_previous_folder/$config_user_cache $bulk_options --run-id unexpire-$(date +"%Y%m%d") -k ${config_alma_analitycs_api_key} -f $config_tempfolder/$config_alma_unexpirations_list"
+fi
 
 if [[ $config_debug ]]; then
-        echo "${#affected_users[@]} users were unexpired."
+        echo "`grep -c . $config_tempfolder/$config_alma_unexpirations_list` users were unexpired."
 fi
 
 # Send summary of changes
-if [[ ${#affected_users[@]} != 0 ]]; then
-        declare message_body
-
-        for key in "${!affected_users[@]}"; do
-                message_body=$(printf "%s\nAssigning patron with barcode %s to group %s.\n" "$message_body" "$key" "${affected_users[$key]}")
-        done
-
-        if [[ $config_send_unexpiration_notice ]]; then
-                printf "%s\n" "${message_body}" | /bin/mail -s "${config_unexpirations_notice_subject}" ${config_unexpirations_notice_recipient}
-        else
-                echo "Not sending unexpirations notice."
-                printf "%s\n" "${message_body}" >&2
-        fi
+if [[ $config_send_unexpiration_notice ]]; then
+        $python_run notify.py -s "${config_unexpirations_notice_subject}" -r ${config_unexpirations_notice_recipient} -u $config_tempfolder/$config_alma_unexpirations_list
+else
+        echo "Not sending unexpirations notice."
+        $python_run notify.py -n -s "${config_unexpirations_notice_subject}" -u $config_tempfolder/$config_alma_unexpirations_list
 fi
 
 if [[ $config_debug ]]; then
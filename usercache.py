@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Local read-through cache of Alma user records, kept in a SQLite database and
+# keyed by primary identifier. Records are fresh for a limited time; stale
+# records that have an ETag can be revalidated with a conditional request
+# instead of being downloaded again. The least recently used records are
+# evicted when the cache grows over its size limit.
+#
+
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+
+
+# Records fetched more than this many seconds ago are revalidated
+DEFAULT_TTL = 6 * 60 * 60
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+# Share of the size limit kept when evicting records
+EVICTION_TARGET = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    primary_id TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    etag TEXT,
+    size INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_accessed ON users (accessed);
+"""
+
+
+class CachedUser:
+    def __init__(self, body, etag, fetched):
+        self.body = body
+        self.etag = etag
+        self.fetched = fetched
+
+    def is_fresh(self, ttl):
+        return time.time() - self.fetched < ttl
+
+
+class UserCache:
+    """
+    Cache of user records, shared by the threads of a process and by the
+    processes using the same file.
+    """
+
+    def __init__(self, file_path, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.size = self.get_size()
+        self.hits = self.revalidations = self.misses = 0
+
+    def close(self):
+        self.connection.close()
+
+    def get_size(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM users").fetchone()[0]
+
+    def get(self, primary_id):
+        """Return the CachedUser of primary_id, fresh or not, or None."""
+        with self.lock:
+            row = self.connection.execute("SELECT body, etag, fetched FROM users WHERE primary_id = ?",
+                                          (primary_id,)).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute("UPDATE users SET accessed = ? WHERE primary_id = ?",
+                                        (time.time(), primary_id))
+
+        return CachedUser(*row)
+
+    def put(self, primary_id, body, etag=None):
+        now = time.time()
+        size = len(body)
+
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM users WHERE primary_id = ?", (primary_id,)).fetchone()
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)",
+                                        (primary_id, body, etag, size, now, now))
+            # A replaced record no longer counts
+            self.size += size - (row[0] if row is not None else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def refresh(self, primary_id):
+        """Mark the record of primary_id as fetched now, after a successful revalidation."""
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute("UPDATE users SET fetched = ?, accessed = ? WHERE primary_id = ?",
+                                        (now, now, primary_id))
+
+    def invalidate(self, primary_id):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM users WHERE primary_id = ?", (primary_id,))
+
+    def evict(self):
+        """Delete the least recently used records until the cache is under its size limit."""
+        self.size = self.get_size()
+        target = self.max_bytes * EVICTION_TARGET
+        if self.size <= target:
+            return
+
+        evicted = []
+        cursor = self.connection.execute("SELECT primary_id, size FROM users ORDER BY accessed")
+        for primary_id, size in cursor:
+            if self.size <= target:
+                break
+            evicted.append((primary_id,))
+            self.size -= size
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM users WHERE primary_id = ?", evicted)
+        logging.info("Evicted %s users from the cache %s." % (len(evicted), self.file_path))
+
+    def purge(self):
+        """Delete every record older than the TTL."""
+        with self.lock:
+            with self.connection:
+                deleted = self.connection.execute("DELETE FROM users WHERE fetched < ?",
+                                                  (time.time() - self.ttl,)).rowcount
+            self.size = self.get_size()
+
+        return deleted
+
+    def stats(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return count, self.get_size()
+
+
+def main(argv):
+    usage = "usage: %prog [options] stats | purge | invalidate PRIMARY_ID..."
+
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--file',
+                      help='Cache file',
+                      dest='file_path')
+    parser.add_option('-t', '--ttl',
+                      help='Age in seconds of the records deleted by purge (default: %s)' % DEFAULT_TTL,
+                      type='int',
+                      default=DEFAULT_TTL,
+                      dest='ttl')
+
+    (options, args) = parser.parse_args()
+
+    if options.file_path is None or len(args) == 0:
+        parser.error('Cache file or command missing.')
+
+    cache = UserCache(options.file_path, options.ttl)
+    command = args[0]
+
+    try:
+        if command == 'stats':
+            print('%s users, %s bytes' % cache.stats())
+        elif command == 'purge':
+            print('%s users deleted' % cache.purge())
+        elif command == 'invalidate':
+            for primary_id in args[1:]:
+                cache.invalidate(primary_id)
+        else:
+            parser.error('Unknown command.')
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
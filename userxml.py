@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Alma user XML writer that serializes Patron records directly, without going
+# through the Jinja template. The output is the same as userdata-template.xml
+# rendered with the patron load's autoescaping template environment.
+#
+
+import re
+
+from xml.sax.saxutils import escape
+
+
+# Quotes are escaped the way Jinja's autoescaping does it
+XML_ENTITIES = { '"': '&#34;', "'": '&#39;' }
+XML_SPECIAL_CHARACTERS = re.compile(u'[&<>"\']')
+
+DOCUMENT_START = u'<?xml version="1.0" encoding="UTF-8"?>\n<users>\n'
+DOCUMENT_END = u'    </users>'
+
+USER_START = u'''    <user>
+        <record_type desc="Public">PUBLIC</record_type>
+        <primary_id>%s</primary_id>
+        <first_name>%s</first_name>
+'''
+MIDDLE_NAME = u'''        <middle_name>%s</middle_name>
+'''
+NO_MIDDLE_NAME = u'''        <middle_name/>
+'''
+NAMES = u'''        <last_name>%s</last_name>
+        <full_name>%s %s</full_name>
+'''
+USER_GROUP = u'''        <user_group desc="%s">%s</user_group>
+'''
+ACCOUNT = u'''        <preferred_language desc="English">en</preferred_language>
+        <expiry_date>%s</expiry_date>
+        <purge_date>%s</purge_date>
+        <account_type desc="External">EXTERNAL</account_type>
+        <external_id>SIS</external_id>
+        <status desc="Active">ACTIVE</status>
+        <contact_info>
+            <addresses>
+                <address segment_type="External" preferred="true">
+                    <line1>%s</line1>
+                    <city>%s</city>
+                    <state_province>%s</state_province>
+                    <postal_code>%s</postal_code>
+                    <country desc="United States">USA</country>
+                    <address_types>
+                        <address_type desc="%s">%s</address_type>
+                    </address_types>
+                </address>
+            </addresses>
+            <emails>
+                <email segment_type="External" preferred="true">
+                    <email_address>%s</email_address>
+                    <email_types>
+                        <email_type desc="%s">%s</email_type>
+                    </email_types>
+                </email>
+            </emails>
+'''
+PHONES_START = u'''            <phones>
+'''
+PHONE = u'''                <phone segment_type="External" preferred="%s" preferred_sms="false">
+                    <phone_number>%s</phone_number>
+                    <phone_types>
+                        <phone_type desc="%s">%s</phone_type>
+                    </phone_types>
+                </phone>
+'''
+PHONES_END = u'''                </phones>
+'''
+IDENTIFIERS = u'''            </contact_info>
+        <user_identifiers>
+            <user_identifier segment_type="External">
+                <id_type desc="University ID">UNIV_ID</id_type>
+                <value>%s</value>
+                <status>ACTIVE</status>
+            </user_identifier>
+        </user_identifiers>
+        <user_roles>
+            <user_role>
+                <status>ACTIVE</status>
+                <scope desc="Portland State University">01ALLIANCE_PSU</scope>
+                <role_type>200</role_type>
+            </user_role>
+        </user_roles>
+'''
+STATISTICS = u'''        <user_statistics>
+            <user_statistic segment_type="External">
+                <statistic_category>%s</statistic_category>
+            </user_statistic>
+        </user_statistics>
+'''
+NO_STATISTICS = u'''        <user_statistics/>
+'''
+USER_END = u'''        </user>
+'''
+
+# Partial record changing only the user group of an external (SIS) user
+GROUP_CHANGE_USER = u'''    <user>
+        <primary_id>%s</primary_id>
+        <user_group>%s</user_group>
+        <account_type desc="External">EXTERNAL</account_type>
+        <external_id>SIS</external_id>
+    </user>
+'''
+
+
+def xml_text(value):
+    """Escape a value for use as XML element text or attribute value."""
+    value = u'%s' % value
+    if XML_SPECIAL_CHARACTERS.search(value) is None:
+        return value
+    return escape(value, XML_ENTITIES)
+
+
+def user_xml(patron):
+    first_name = xml_text(patron.first_name)
+    last_name = xml_text(patron.last_name)
+    parts = [USER_START % (xml_text(patron.barcode), first_name)]
+
+    if patron.middle_name:
+        parts.append(MIDDLE_NAME % xml_text(patron.middle_name))
+    else:
+        parts.append(NO_MIDDLE_NAME)
+    parts.append(NAMES % (last_name, first_name, last_name))
+    if patron.patron_type:
+        parts.append(USER_GROUP % (xml_text(patron.patron_type.title()), xml_text(patron.patron_type)))
+
+    parts.append(ACCOUNT % (xml_text(patron.expdate), xml_text(patron.purge_date),
+                            xml_text(patron.address_line1), xml_text(patron.city), xml_text(patron.state),
+                            xml_text(patron.zip_code), xml_text(patron.address_type.title()),
+                            xml_text(patron.address_type), xml_text(patron.email),
+                            xml_text(patron.email_address_type.title()), xml_text(patron.email_address_type)))
+
+    if patron.telephone or patron.telephone2:
+        parts.append(PHONES_START)
+        if patron.telephone:
+            parts.append(PHONE % (u'true', xml_text(patron.telephone), xml_text(patron.telephone_type.title()),
+                                  xml_text(patron.telephone_type)))
+        if patron.telephone2:
+            parts.append(PHONE % (u'false', xml_text(patron.telephone2),
+                                  xml_text(patron.telephone2_type.title()), xml_text(patron.telephone2_type)))
+        parts.append(PHONES_END)
+
+    parts.append(IDENTIFIERS % xml_text(patron.username.lower()))
+    if patron.department_code:
+        parts.append(STATISTICS % xml_text(patron.department_code))
+    else:
+        parts.append(NO_STATISTICS)
+    parts.append(USER_END)
+
+    return u''.join(parts)
+
+
+def write_group_changes(group_changes, output_file):
+    """Write a barcode-keyed dict of group names as an Alma users document of partial records."""
+    output_file.write(DOCUMENT_START.encode('utf-8'))
+    for barcode, group_name in group_changes.items():
+        output_file.write((GROUP_CHANGE_USER % (xml_text(barcode), xml_text(group_name))).encode('utf-8'))
+    output_file.write(DOCUMENT_END.encode('utf-8'))